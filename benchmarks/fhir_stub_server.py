@@ -0,0 +1,262 @@
+import datetime
+import json
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _date(value:str):
+    return value[:10] if value else None
+
+
+def _inDateRange(value:str, filters:list):
+    # filters are the date= parameters, eg ['ge2020-01-01', 'le2020-01-31']
+    date = _date(value)
+    for f in filters:
+        if date is None:
+            return False
+        if f.startswith('ge') and date < f[2:]:
+            return False
+        if f.startswith('le') and date > f[2:]:
+            return False
+    return True
+
+
+def _observationDate(resource:dict):
+    return resource.get('effectiveDateTime') or resource.get('issued')
+
+
+def _kept(key:str, elements:set):
+    # choice elements are asked for without their type suffix, eg value keeps valueQuantity
+    return key in elements or any(key.startswith(x) and key[len(x):][:1].isupper() for x in elements)
+
+
+class StubFhirServer():
+    """ local stand-in for a HAPI fhir server serving a SyntheticCohort, for benchmarking without a
+        production server. it answers the searches and reads the pipeline makes (Patient, Encounter,
+        Observation, MedicationRequest, Medication, Condition) and pages results HAPI style: every
+        searchset has a link relation next of the form <base>/fhir?_getpages=<id>&_getpagesoffset=<n>&_count=<n>,
+        which is what FhirConnection.getNextUrl rebuilds for conn_type hapi. a batch Bundle POSTed to /fhir
+        is answered with a batch-response holding each GET entry's result, and MedicationRequest searches
+        honor _include=MedicationRequest:medication; batch=False answers batch POSTs with 405 instead.
+        _count is honored up to max_page_size, like a server with a page size limit
+        latency adds a fixed delay (seconds) to every response to mimic a remote server, and max_rate
+        (requests per second) answers requests over that rate with 429 and Retry-After like a throttled endpoint
+    Example:
+        with StubFhirServer(cohort, page_size=50) as server:
+            conn=FhirConnection.fromConfig(server.config())
+    """
+
+    def __init__(self, cohort, page_size:int=50, latency:float=0.0, max_rate:float=None, batch:bool=True,
+                 max_page_size:int=None, host:str='127.0.0.1', port:int=0):
+        self.cohort = cohort
+        self.max_page_size = max_page_size
+        self.batch = batch
+        self.page_size = page_size
+        self.latency = latency
+        self.max_rate = max_rate
+        self.tokens = max_rate or 0
+        self.tokens_updated = time.monotonic()
+        self.throttled = 0
+        self.searches = OrderedDict() # _getpages id -> (full result list, _include medications, search time), oldest dropped first
+        self.max_searches = 10000
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self.patients_by_mrn = {p['identifier'][0]['value']: p for p in cohort.patients.values()}
+        self.encounters_by_id = {e['id']: e for e in cohort.encounters}
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive so the pooled session is measured as in production
+            disable_nagle_algorithm = True # headers and body are separate writes; avoid the delayed ack stall
+            def do_GET(self):
+                server.handle(self)
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                server.handle(self, json.loads(body or b'{}'))
+            def log_message(self, format, *args):
+                pass
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://{host}:{self.httpd.server_address[1]}'
+        self._thread = None
+
+    def config(self):
+        """fhirconfig section for FhirConnection.fromConfig"""
+        return {'url_root_fhir': self.url, 'url2_fhir': '/fhir', 'conn_type': 'hapi', 'auth_type': 'none',
+                'headers': {'Accept': 'application/fhir+json'}}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def handle(self, request, posted:dict=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttle():
+            status, body = 429, self.outcome('Too many requests')
+        elif posted is not None:
+            status, body = self.transaction(request.path, posted)
+        else:
+            status, body = self.route(request.path)
+        data = json.dumps(body).encode('utf-8')
+        with self._lock:
+            self.requests = self.requests + 1
+            self.bytes_sent = self.bytes_sent + len(data)
+        request.send_response(status)
+        if status == 429:
+            request.send_header('Retry-After', '1')
+        request.send_header('Content-Type', 'application/fhir+json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def throttle(self):
+        # token bucket of max_rate per second with a one second burst
+        if self.max_rate is None:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.max_rate, self.tokens + (now - self.tokens_updated) * self.max_rate)
+            self.tokens_updated = now
+            if self.tokens >= 1:
+                self.tokens = self.tokens - 1
+                return False
+            self.throttled = self.throttled + 1
+            return True
+
+    def route(self, path:str):
+        parts = urllib.parse.urlsplit(path)
+        segments = [x for x in parts.path.split('/') if x]
+        # search parameters appended with & but no ? end up in the path, which a real server rejects
+        if any('&' in x or '=' in x for x in segments):
+            return 400, self.outcome(f'Invalid resource path {parts.path}')
+        query = urllib.parse.parse_qs(parts.query)
+        if segments[:1] != ['fhir']:
+            return 404, self.outcome(f'Unknown path {parts.path}')
+        if len(segments) == 1 and '_getpages' in query:
+            return self.page(query['_getpages'][0], int(query.get('_getpagesoffset', ['0'])[0]),
+                             int(query.get('_count', [str(self.page_size)])[0]))
+        if len(segments) == 3:
+            return self.read(segments[1].lower(), segments[2])
+        if len(segments) == 2:
+            return self.search(segments[1].lower(), query)
+        return 404, self.outcome(f'Unknown path {parts.path}')
+
+    def transaction(self, path:str, bundle:dict):
+        # only batch Bundles of GETs against the base url, which is what models.batch_fhir sends
+        if not self.batch or urllib.parse.urlsplit(path).path.rstrip('/') != '/fhir':
+            return 405, self.outcome(f'POST {path} not supported')
+        if bundle.get('resourceType') != 'Bundle' or bundle.get('type') != 'batch':
+            return 400, self.outcome('Expected a batch Bundle')
+        entries = []
+        for entry in bundle.get('entry') or []:
+            request = entry.get('request') or {}
+            if request.get('method') != 'GET':
+                status, body = 405, self.outcome(f"{request.get('method')} not supported in batch")
+            else:
+                status, body = self.route('/fhir/' + request.get('url', '').lstrip('/'))
+            entries.append({'resource': body, 'response': {'status': str(status)}})
+        return 200, {'resourceType': 'Bundle', 'type': 'batch-response', 'entry': entries}
+
+    def read(self, resource:str, id:str):
+        if resource == 'patient':
+            found = self.cohort.patients.get(id)
+        elif resource == 'medication':
+            found = self.cohort.medications.get(id)
+        elif resource == 'encounter':
+            found = self.encounters_by_id.get(id)
+        elif resource == 'observation': # scanned, so observations added to the cohort later are found too
+            found = next((x for obs in self.cohort.observations.values() for x in obs['vital-signs'] + obs['laboratory'] if x['id'] == id), None)
+        elif resource == 'condition':
+            found = next((x for conds in self.cohort.conditions.values() for x in conds if x['id'] == id), None)
+        else:
+            found = None
+        if found is None:
+            return 404, self.outcome(f'{resource}/{id} not found')
+        return 200, found
+
+    def search(self, resource:str, query:dict):
+        cohort = self.cohort
+        patid = query.get('patient', [None])[0]
+        dates = query.get('date', [])
+        since = query.get('_lastUpdated', [None])[0]
+        if resource == 'patient':
+            if 'identifier' in query:
+                found = self.patients_by_mrn.get(query['identifier'][0])
+                results = [found] if found is not None else []
+            elif '_id' in query:
+                ids = query['_id'][0].split(',')
+                results = [cohort.patients[x] for x in ids if x in cohort.patients]
+            else:
+                results = list(cohort.patients.values())
+        elif resource == 'encounter':
+            results = [x for x in cohort.encounters if _inDateRange(x['period']['start'], dates)]
+        elif resource == 'observation':
+            category = query.get('category', [None])[0]
+            observations = cohort.observations.get(patid, {})
+            candidates = observations.get(category, []) if category else [x for obs in observations.values() for x in obs]
+            results = [x for x in candidates if _inDateRange(_observationDate(x), dates)]
+        elif resource == 'medicationrequest':
+            results = [x for x in cohort.medication_requests.get(patid, []) if _inDateRange(x['authoredOn'], dates)]
+        elif resource == 'condition':
+            results = cohort.conditions.get(patid, [])
+        elif resource == 'medication':
+            ids = query['_id'][0].split(',') if '_id' in query else list(cohort.medications)
+            results = [cohort.medications[x] for x in ids if x in cohort.medications]
+        else:
+            return 404, self.outcome(f'Unknown resource {resource}')
+        if since is not None:
+            results = [x for x in results if x.get('meta', {}).get('lastUpdated', '') > since[2:]]
+        if '_elements' in query: # summary view with only the asked for elements
+            keep = set(query['_elements'][0].split(',')) | {'resourceType', 'id', 'meta'}
+            results = [{k: v for k, v in x.items() if _kept(k, keep)} for x in results]
+        include = resource == 'medicationrequest' and 'MedicationRequest:medication' in query.get('_include', [])
+        count = int(query.get('_count', [str(self.page_size)])[0])
+        if self.max_page_size is not None:
+            count = min(count, self.max_page_size)
+        search_id = uuid.uuid4().hex
+        with self._lock:
+            self.searches[search_id] = (results, include, datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+            while len(self.searches) > self.max_searches:
+                self.searches.popitem(last=False)
+        return self.page(search_id, 0, count)
+
+    def page(self, search_id:str, offset:int, count:int):
+        with self._lock:
+            search = self.searches.get(search_id)
+        if search is None:
+            return 410, self.outcome(f'Search {search_id} has expired')
+        results, include, searched = search
+        # meta.lastUpdated is when the search ran, like HAPI
+        bundle = {'resourceType': 'Bundle', 'meta': {'lastUpdated': searched}, 'type': 'searchset', 'total': len(results), 'link': []}
+        if offset + count < len(results):
+            bundle['link'].append({'relation': 'next', 'url': f'{self.url}/fhir?_getpages={search_id}'
+                                   f'&_getpagesoffset={offset + count}&_count={count}&_bundletype=searchset'})
+        entries = results[offset:offset + count]
+        if include: # each page carries the Medications its MedicationRequests reference, like HAPI
+            ids = dict.fromkeys(x['medicationReference']['reference'].split('/')[1] for x in entries)
+            included = [self.cohort.medications[x] for x in ids if x in self.cohort.medications]
+        else:
+            included = []
+        if entries: # empty searchsets have no entry
+            bundle['entry'] = ([{'fullUrl': f"{self.url}/fhir/{x['resourceType']}/{x['id']}", 'resource': x, 'search': {'mode': 'match'}} for x in entries]
+                               + [{'fullUrl': f"{self.url}/fhir/Medication/{x['id']}", 'resource': x, 'search': {'mode': 'include'}} for x in included])
+        return 200, bundle
+
+    def outcome(self, text:str):
+        return {'resourceType': 'OperationOutcome', 'issue': [{'severity': 'error', 'code': 'processing', 'diagnostics': text}]}
@@ -0,0 +1,146 @@
+"""offline benchmark of the seneca pipeline against a local StubFhirServer with synthetic data.
+reports wall time and throughput for each stage (cohort retrieval, fetch, parse, feature build,
+scoring) and for senecaControl end to end, so changes can be compared run to run.
+needs the same reference csvs as senecacontroller (df_valuesets/seneca_loincs) but no fhir server or vault
+Example:
+    python benchmarks/run_benchmark.py --patients 200 --obs-per-patient 400 --max-workers 8 --json bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from controllers.fhir_connection import FhirConnection
+from controllers.getCohortHAPI import getHapiCohort
+from controllers.metrics import metrics
+from controllers.senecacontroller import senecaControl, getEncounterWindow, getFhirId, df_valuesets, seneca_loincs, axb_vs
+from models.getKPHCFHIR import getPatient, getObservation, getMedicationRequest, getCondition, medication_cache
+from models.seneca import getSenecaData, senecaScoreBatch
+import models.parse_fhir as parse_fhir
+from synthetic_fhir import SyntheticCohort
+from fhir_stub_server import StubFhirServer
+
+
+class StageTimer():
+    """collects (stage, seconds, items, items per second) rows"""
+
+    def __init__(self):
+        self.stages = []
+
+    def run(self, stage:str, unit:str, fn):
+        start = time.perf_counter()
+        result, items = fn()
+        seconds = time.perf_counter() - start
+        self.stages.append({'stage': stage, 'seconds': round(seconds, 4), 'items': items, 'unit': unit,
+                            'per_second': round(items / seconds, 2) if seconds > 0 else None})
+        logging.info(f"{stage}: {seconds:.3f}s for {items} {unit}")
+        return result
+
+    def frame(self):
+        return pd.DataFrame(self.stages)
+
+
+def fetchInputs(df:pd.DataFrame, conn:FhirConnection):
+    """raw json pages per cohort row (the fetch stage of getPatientInputs without parsing)"""
+    fetched = []
+    n_pages = 0
+    for index, row in df.iterrows():
+        admit_datetime, start_date_txt, end_date_txt = getEncounterWindow(row)
+        fhir_id = getFhirId(row, conn)
+        inputs = {'row': row, 'patient': getPatient(patID=fhir_id, fhirconn=conn),
+                  'vitals': getObservation(patID=fhir_id, category='vital-signs', fhirconn=conn, start_date=start_date_txt, end_date=end_date_txt),
+                  'labs': getObservation(patID=fhir_id, category='laboratory', fhirconn=conn, start_date=start_date_txt, end_date=end_date_txt),
+                  'meds': getMedicationRequest(patID=fhir_id, fhirconn=conn, start_date=start_date_txt, end_date=end_date_txt),
+                  'conds': getCondition(patID=fhir_id, fhirconn=conn, start_date=start_date_txt, end_date=end_date_txt)}
+        n_pages = n_pages + 1 + sum(len(inputs[x]) for x in ['vitals', 'labs', 'meds', 'conds'])
+        fetched.append(inputs)
+    return fetched, n_pages
+
+
+def parseInputs(fetched:list, conn:FhirConnection, strict:bool):
+    parsed = []
+    n_rows = 0
+    for inputs in fetched:
+        admit_datetime, start_date_txt, end_date_txt = getEncounterWindow(inputs['row'])
+        frames = {'start_date_txt': start_date_txt,
+                  'pat': parse_fhir.parsePatient(inputs['patient'], strict=strict),
+                  'vitals': pd.concat([parse_fhir.parseObservation(x, df_valuesets, strict=strict) for x in inputs['vitals']]),
+                  'labs': pd.concat([parse_fhir.parseObservation(x, df_valuesets, strict=strict) for x in inputs['labs']]),
+                  'meds': pd.concat([parse_fhir.parseMedRequest(x, fhirconn=conn, start_date=admit_datetime, vs=axb_vs, batch=True, strict=strict)
+                                     for x in inputs['meds']]),
+                  'conds': pd.concat([parse_fhir.parseCondition(x, strict=strict) for x in inputs['conds']])}
+        n_rows = n_rows + sum(len(frames[x].index) for x in ['vitals', 'labs', 'meds', 'conds'])
+        parsed.append(frames)
+    return parsed, n_rows
+
+
+def buildFeatures(parsed:list):
+    rows = [getSenecaData(dfPat=x['pat'], dfLabs=x['labs'], dfVitals=x['vitals'], dfConds=x['conds'],
+                          dfSenecaList=seneca_loincs, enctr_date=x['start_date_txt']) for x in parsed]
+    return pd.concat(rows), len(rows)
+
+
+def runBenchmark(patients:int=100, obs_per_patient:int=200, meds_per_patient:int=10, conds_per_patient:int=8,
+                 page_size:int=50, latency:float=0.0, max_workers:int=None, strict:bool=True, seed:int=0, server_rate:float=None,
+                 batch_queries:bool=True):
+    """runs every stage once and returns (stage timings dataframe, run details dict). the fetch stage always
+    makes single searches; batch_queries only applies to senecaControl"""
+    timer = StageTimer()
+    cohort = timer.run('generate', 'patients', lambda: (SyntheticCohort(patients, obs_per_patient, meds_per_patient, conds_per_patient,
+                                                                         df_valuesets=df_valuesets, seneca_loincs=seneca_loincs, seed=seed), patients))
+    with StubFhirServer(cohort, page_size=page_size, latency=latency, max_rate=server_rate) as server:
+        conn = FhirConnection.fromConfig(dict(server.config(), batch_queries=batch_queries))
+        df = timer.run('getHapiCohort', 'patients', lambda: (lambda x: (x, len(x.index)))(getHapiCohort(conn, n=patients)))
+        medication_cache.clear()
+        fetched = timer.run('fetch', 'pages', lambda: fetchInputs(df, conn))
+        parsed = timer.run('parse', 'rows', lambda: parseInputs(fetched, conn, strict))
+        del fetched
+        df_features = timer.run('features', 'patients', lambda: buildFeatures(parsed))
+        del parsed
+        timer.run('score', 'patients', lambda: (senecaScoreBatch(df_features), len(df_features.index)))
+        medication_cache.clear()
+        requests_before = server.requests
+        timer.run('senecaControl', 'patients', lambda: (lambda x: (x, len(x)))(senecaControl(df, conn, max_workers=max_workers, strict=strict)))
+        details = {'patients': patients, 'obs_per_patient': obs_per_patient, 'meds_per_patient': meds_per_patient,
+                   'conds_per_patient': conds_per_patient, 'page_size': page_size, 'latency': latency,
+                   'max_workers': max_workers, 'strict': strict, 'batch_queries': batch_queries, 'resources': cohort.counts(),
+                   'server_requests': server.requests, 'senecaControl_requests': server.requests - requests_before,
+                   'server_rate': server_rate, 'server_throttled': server.throttled,
+                   'server_mb_sent': round(server.bytes_sent / 1024**2, 2)}
+    return timer.frame(), details
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='offline seneca pipeline benchmark')
+    parser.add_argument('--patients', type=int, default=100)
+    parser.add_argument('--obs-per-patient', type=int, default=200)
+    parser.add_argument('--meds-per-patient', type=int, default=10)
+    parser.add_argument('--conds-per-patient', type=int, default=8)
+    parser.add_argument('--page-size', type=int, default=50, help='searchset page size of the stub server')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every stub server response')
+    parser.add_argument('--server-rate', type=float, default=None, help='stub server answers 429 above this many requests/second')
+    parser.add_argument('--max-workers', type=int, default=None, help='senecaControl max_workers')
+    parser.add_argument('--fast', action='store_true', help='strict=False (FastResource parsers)')
+    parser.add_argument('--no-batch', action='store_true', help='senecaControl makes single searches instead of batch Bundle POSTs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None, help='also write the results to this json file')
+    parser.add_argument('--metrics', default=None, help='write the controllers.metrics prometheus text to this file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    df_stages, details = runBenchmark(args.patients, args.obs_per_patient, args.meds_per_patient, args.conds_per_patient,
+                                      args.page_size, args.latency, args.max_workers, not args.fast, args.seed,
+                                      args.server_rate, not args.no_batch)
+    print(json.dumps(details, indent=2))
+    print(df_stages.to_string(index=False))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'details': details, 'stages': df_stages.to_dict(orient='records'), 'metrics': metrics.toJson()}, f, indent=2)
+    if args.metrics is not None:
+        metrics.writePrometheus(args.metrics)
@@ -0,0 +1,80 @@
+"""latency benchmark of controllers.scoring_service against a local StubFhirServer. every synthetic ED
+encounter is POSTed to the service (/score, or /notification as subscription notification Bundles) from
+--clients concurrent clients and the service's p50/p99 notification to phenotype latency is reported.
+needs the same reference csvs as senecacontroller but no fhir server or vault
+Example:
+    python benchmarks/run_service_benchmark.py --patients 200 --latency 0.02 --max-workers 8 --clients 8
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from controllers.fhir_connection import FhirConnection
+from controllers.scoring_service import ScoringService, service_seconds
+from controllers.senecacontroller import getValuesets, getSenecaLoincs
+from models.getKPHCFHIR import medication_cache
+from synthetic_fhir import SyntheticCohort
+from fhir_stub_server import StubFhirServer
+
+
+def runServiceBenchmark(patients:int=100, obs_per_patient:int=200, page_size:int=50, latency:float=0.0,
+                        max_workers:int=4, clients:int=4, notifications:bool=False, strict:bool=True, seed:int=0):
+    """scores every encounter of a synthetic cohort through the service's http api and returns a details dict"""
+    cohort = SyntheticCohort(patients, obs_per_patient, df_valuesets=getValuesets(), seneca_loincs=getSenecaLoincs(), seed=seed)
+    published = []
+    with StubFhirServer(cohort, page_size=page_size, latency=latency) as server:
+        conn = FhirConnection.fromConfig(server.config())
+        medication_cache.clear()
+        service_seconds.reset()
+        start = time.perf_counter()
+        with ScoringService(conn, max_workers=max_workers, strict=strict, publish=published.append) as service:
+            warmup = time.perf_counter() - start
+            httpd = service.serve(port=0, host='127.0.0.1')
+            url = f'http://127.0.0.1:{httpd.server_address[1]}'
+            references = ['Encounter/' + x['id'] for x in cohort.encounters]
+            session = requests.Session()
+            start = time.perf_counter()
+            if notifications: # id-only subscription notifications, one encounter each
+                def send(reference):
+                    bundle = {'resourceType': 'Bundle', 'type': 'history', 'entry': [{'fullUrl': f'{server.url}/fhir/{reference}'}]}
+                    return session.post(url + '/notification', json=bundle).status_code
+            else:
+                def send(reference):
+                    return session.post(url + '/score', json={'encounter': reference}).status_code
+            with ThreadPoolExecutor(max_workers=clients) as pool:
+                statuses = list(pool.map(send, references))
+            while len(published) < len(references): # notifications are scored after they are acknowledged
+                time.sleep(0.01)
+            seconds = time.perf_counter() - start
+            summary = service.latency()
+    return {'patients': patients, 'obs_per_patient': obs_per_patient, 'page_size': page_size, 'latency': latency,
+            'max_workers': max_workers, 'clients': clients, 'notifications': notifications, 'strict': strict,
+            'warmup_seconds': round(warmup, 3), 'seconds': round(seconds, 3),
+            'encounters_per_second': round(len(references) / seconds, 2), 'http_statuses': sorted(set(statuses)),
+            'phenotypes': {x: sum(1 for r in published if r.get('phenotype') == x) for x in sorted({r.get('phenotype') for r in published if r.get('phenotype')})},
+            'service': summary, 'server_requests': server.requests}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='scoring service latency benchmark')
+    parser.add_argument('--patients', type=int, default=100)
+    parser.add_argument('--obs-per-patient', type=int, default=200)
+    parser.add_argument('--page-size', type=int, default=50, help='searchset page size of the stub server')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every stub server response')
+    parser.add_argument('--max-workers', type=int, default=4, help='encounters the service scores at once')
+    parser.add_argument('--clients', type=int, default=4, help='concurrent clients posting encounters')
+    parser.add_argument('--notifications', action='store_true', help='send subscription notifications instead of /score')
+    parser.add_argument('--fast', action='store_true', help='strict=False (FastResource parsers)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    print(json.dumps(runServiceBenchmark(args.patients, args.obs_per_patient, args.page_size, args.latency, args.max_workers,
+                                         args.clients, args.notifications, not args.fast, args.seed), indent=2))
@@ -0,0 +1,153 @@
+import datetime
+import random
+import pandas as pd
+
+# seneca variables that come from vital-signs Observations; the other lab variables are laboratory
+vital_variables = ['hr', 'rr', 'sbp', 'temp', 'sao2', 'gcs']
+
+# (mean, sd, unit) of a plausible ED result for each seneca variable the generator emits
+variable_ranges = {
+    'alb': (3.5, 0.6, 'g/dL'), 'alt': (40, 30, 'U/L'), 'ast': (45, 35, 'U/L'), 'bands': (5, 4, '%'),
+    'bicarb': (24, 4, 'mmol/L'), 'bili': (1.0, 0.8, 'mg/dL'), 'bun': (22, 12, 'mg/dL'), 'cl': (102, 5, 'mmol/L'),
+    'creat': (1.2, 0.7, 'mg/dL'), 'crp': (5, 4, 'mg/dL'), 'esr': (30, 20, 'mm/h'), 'gcs': (14, 1.5, '{score}'),
+    'gluc': (130, 40, 'mg/dL'), 'hgb': (12, 2, 'g/dL'), 'hr': (95, 20, '/min'), 'inr': (1.2, 0.3, '{INR}'),
+    'lactate': (2.0, 1.2, 'mmol/L'), 'pao2': (85, 20, 'mm[Hg]'), 'plt': (230, 80, '10*3/uL'), 'rr': (20, 5, '/min'),
+    'sao2': (95, 3, '%'), 'sodium': (138, 4, 'mmol/L'), 'sbp': (120, 25, 'mm[Hg]'), 'temp': (99.5, 1.8, 'DegF'),
+    'trop': (0.05, 0.04, 'ng/mL'), 'wbc': (11, 5, '10*3/uL'),
+}
+
+# icd-10 codes the conditions are drawn from (common elixhauser comorbidities and ed diagnoses)
+condition_codes = ['I50.9', 'E11.9', 'N18.3', 'J44.9', 'I10', 'C34.90', 'K70.30', 'F10.20', 'D64.9', 'E66.9',
+                   'I48.91', 'A41.9', 'J18.9', 'N39.0', 'R65.20', 'E87.1', 'F32.9', 'G30.9', 'B20', 'K21.9']
+
+# rxnorm codes of the generated Medications; the first half are in the antibiotic value set axb_vs
+medication_codes = ['722', '19711', '733', '2193', '2194', '2348', '3640', '7623', '10395', '11124',
+                    '161', '1191', '6809', '5640', '29046', '32968', '36567', '41493', '83367', '197361']
+
+
+def _instant(dt:datetime.datetime):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class SyntheticCohort():
+    """ reproducible synthetic fhir data for an ED cohort: one Patient and one ED Encounter per patient
+        plus vital-signs and laboratory Observations, MedicationRequests (with their Medications) and
+        Conditions. Observation codes come from the valueset tables so they map to seneca data elements;
+        noise_fraction of the Observations use codes outside the valuesets, like real lab feeds
+    Args:
+        n_patients: cohort size
+        obs_per_patient: Observations per patient (split between vitals and labs)
+        meds_per_patient, conds_per_patient: MedicationRequests and Conditions per patient
+        df_valuesets, seneca_loincs: the reference tables senecacontroller loads (code/de and key/variable_name)
+    Example:
+        cohort=SyntheticCohort(500, obs_per_patient=400, df_valuesets=df_valuesets, seneca_loincs=seneca_loincs)
+    """
+
+    def __init__(self, n_patients:int, obs_per_patient:int=200, meds_per_patient:int=10, conds_per_patient:int=8,
+                 df_valuesets:pd.DataFrame=None, seneca_loincs:pd.DataFrame=None, noise_fraction:float=0.2, seed:int=0):
+        self.random = random.Random(seed)
+        self.codes = self.variableCodes(df_valuesets, seneca_loincs)
+        self.patients = {}
+        self.encounters = []
+        self.observations = {} # patient id -> category -> list of Observations
+        self.medication_requests = {}
+        self.conditions = {}
+        self.medications = {}
+        for code in medication_codes:
+            self.medications['med' + code] = {
+                'resourceType': 'Medication', 'id': 'med' + code,
+                'code': {'coding': [{'system': 'http://www.nlm.nih.gov/research/umls/rxnorm', 'code': code}], 'text': 'Medication ' + code},
+                'form': {'text': 'Injection'}}
+        for n in range(n_patients):
+            self.addPatient(n, obs_per_patient, meds_per_patient, conds_per_patient, noise_fraction)
+
+    def variableCodes(self, df_valuesets:pd.DataFrame, seneca_loincs:pd.DataFrame):
+        """variable_name -> list of (loinc code, display) whose valueset de is the variable's seneca key"""
+        codes = {}
+        if df_valuesets is None or seneca_loincs is None:
+            return codes
+        keys = dict(zip(seneca_loincs['key'], seneca_loincs['variable_name']))
+        for record in df_valuesets.to_dict(orient='records'):
+            variable = keys.get(record.get('de'))
+            if variable in variable_ranges:
+                codes.setdefault(variable, []).append((str(record['code']), record.get('description')))
+        return codes
+
+    def addPatient(self, n:int, obs_per_patient:int, meds_per_patient:int, conds_per_patient:int, noise_fraction:float):
+        rnd = self.random
+        patid = f'pat{n}'
+        encid = f'enc{n}'
+        admit = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(minutes=rnd.randrange(3*365*24*60))
+        discharge = admit + datetime.timedelta(hours=rnd.randint(4, 240))
+        self.patients[patid] = {
+            'resourceType': 'Patient', 'id': patid, 'gender': rnd.choice(['male', 'female']),
+            'birthDate': (admit - datetime.timedelta(days=rnd.randint(18*365, 95*365))).strftime('%Y-%m-%d'),
+            'identifier': [{'type': {'text': 'MRN'}, 'value': f'MRN{n:08d}'}]}
+        self.encounters.append({
+            'resourceType': 'Encounter', 'id': encid, 'status': 'finished',
+            'class': {'system': 'http://terminology.hl7.org/CodeSystem/v3-ActCode', 'code': 'EMER'},
+            'subject': {'reference': 'Patient/' + patid},
+            'period': {'start': _instant(admit), 'end': _instant(discharge)}})
+
+        observations = {'vital-signs': [], 'laboratory': []}
+        variables = list(self.codes) or list(variable_ranges)
+        for i in range(obs_per_patient):
+            when = admit + datetime.timedelta(minutes=rnd.randrange(int((discharge - admit).total_seconds() // 60)))
+            variable = rnd.choice(variables)
+            category = 'vital-signs' if variable in vital_variables else 'laboratory'
+            if self.codes and rnd.random() >= noise_fraction:
+                code, display = rnd.choice(self.codes[variable])
+            else: # code outside the valuesets
+                code, display = f'{rnd.randint(10000, 99999)}-{rnd.randint(0, 9)}', 'Other result'
+            mean, sd, unit = variable_ranges[variable]
+            observation = {
+                'resourceType': 'Observation', 'id': f'obs{n}-{i}', 'status': 'final',
+                'category': [{'coding': [{'system': 'http://terminology.hl7.org/CodeSystem/observation-category', 'code': category}]}],
+                'code': {'coding': [{'system': 'http://loinc.org', 'code': code, 'display': display}], 'text': display},
+                'subject': {'reference': 'Patient/' + patid}, 'encounter': {'reference': 'Encounter/' + encid},
+                'effectiveDateTime': _instant(when), 'issued': _instant(when),
+                'meta': {'lastUpdated': _instant(when)}}
+            if category == 'laboratory' and rnd.random() < 0.05:
+                observation['valueString'] = 'See comment'
+            else:
+                observation['valueQuantity'] = {'value': round(max(rnd.gauss(mean, sd), 0.01), 2), 'unit': unit}
+            observations[category].append(observation)
+        self.observations[patid] = observations
+
+        requests = []
+        for i in range(meds_per_patient):
+            when = admit + datetime.timedelta(minutes=rnd.randrange(24*60))
+            requests.append({
+                'resourceType': 'MedicationRequest', 'id': f'medreq{n}-{i}', 'status': 'active', 'intent': 'order',
+                'category': [{'text': 'Inpatient'}], 'courseOfTherapyType': {'text': 'Acute'},
+                'medicationReference': {'reference': 'Medication/med' + rnd.choice(medication_codes), 'display': 'Medication'},
+                'subject': {'reference': 'Patient/' + patid}, 'encounter': {'reference': 'Encounter/' + encid},
+                'authoredOn': _instant(when), 'meta': {'lastUpdated': _instant(when)}})
+        self.medication_requests[patid] = requests
+
+        conditions = []
+        for i, code in enumerate(rnd.sample(condition_codes, min(conds_per_patient, len(condition_codes)))):
+            onset = admit - datetime.timedelta(days=rnd.randint(0, 3650))
+            conditions.append({
+                'resourceType': 'Condition', 'id': f'cond{n}-{i}', 'subject': {'reference': 'Patient/' + patid},
+                'category': [{'text': 'Problem List'}],
+                'code': {'coding': [{'system': 'http://hl7.org/fhir/sid/icd-10-cm', 'code': code}], 'text': 'Condition ' + code},
+                'onsetPeriod': {'start': _instant(onset)}, 'meta': {'lastUpdated': _instant(onset)}})
+        self.conditions[patid] = conditions
+
+    def cohort(self):
+        """cohort dataframe in the getHapiCohort format, for benchmarking senecaControl on its own"""
+        rows = []
+        for encounter in self.encounters:
+            patid = encounter['subject']['reference'].split('/')[1]
+            rows.append({'patid': patid, 'pat_enc_csn_id': encounter['id'], 'urn': None,
+                         'admit_datetime': encounter['period']['start'].replace('T', ' ').replace('Z', ' +00:00'),
+                         'dis_datetime': encounter['period']['end'].replace('T', ' ').replace('Z', ' +00:00'),
+                         'MRN': self.patients[patid]['identifier'][0]['value']})
+        return pd.DataFrame(rows)
+
+    def counts(self):
+        return {'Patient': len(self.patients), 'Encounter': len(self.encounters),
+                'Observation': sum(len(x) for obs in self.observations.values() for x in obs.values()),
+                'MedicationRequest': sum(len(x) for x in self.medication_requests.values()),
+                'Medication': len(self.medications), 'Condition': sum(len(x) for x in self.conditions.values())}
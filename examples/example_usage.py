@@ -1,6 +1,6 @@
 import logging
 import pandas as pd
-from src.controllers.fhir_connection import FhirConnection, FHIRInstance
+from src.controllers.fhir_connection import getFhirConnection, FHIRInstance
 from src.controllers.getCohortHAPI import getHapiCohort
 from src.controllers.senecacontroller import senecaControl
 
@@ -8,7 +8,7 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     
     # Connect to FHIR server (update FHIRInstance as needed)
-    conn = FhirConnection(FHIRInstance.HAPI_FHIR_PROD)
+    conn = getFhirConnection(FHIRInstance.HAPI_FHIR_PROD)
     
     # Fetch cohort
     df_cohort = getHapiCohort(conn, n=10)
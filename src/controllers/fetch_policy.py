@@ -0,0 +1,224 @@
+import email.utils
+import logging
+import random
+import threading
+import time
+import requests
+from controllers.metrics import metrics
+
+http_retries = metrics.counter('fhir_http_retries_total', 'FHIR requests retried, by reason (status code or exception)', ('resource', 'reason'))
+http_throttled = metrics.counter('fhir_http_throttled_total', '429/503 responses that reduced the concurrency limit', ('server',))
+
+# statuses worth retrying. POSTs are only retried on the throttling ones, where the server did not process the request
+retry_statuses = (429, 500, 502, 503, 504)
+throttle_statuses = (429, 503)
+
+
+def parseRetryAfter(value:str):
+    """seconds to wait from a Retry-After header (delta seconds or an http date); None if missing or bad"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except Exception:
+        return None
+
+
+class TokenBucket():
+    """ rate limiter: rate tokens per second up to burst; take() blocks until a token is free.
+        pause(seconds) holds every caller back, eg for a server Retry-After
+    """
+
+    def __init__(self, rate:float, burst:float=None):
+        self.rate = rate
+        self.burst = burst or (max(rate, 1) if rate else 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate is None:
+                    return
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens = self.tokens - 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds:float):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveConcurrency():
+    """ limit on requests in flight that adapts AIMD style: every success raises it by 1/limit up to
+        max_limit and a throttled response halves it (at most once per cooldown seconds) down to min_limit
+    """
+
+    def __init__(self, max_limit:int, min_limit:int=1, cooldown:float=1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.cooldown = cooldown
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.decreased = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight = self.in_flight + 1
+
+    def release(self, throttled:bool=False):
+        with self._cond:
+            self.in_flight = self.in_flight - 1
+            now = time.monotonic()
+            if throttled:
+                if now - self.decreased >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.decreased = now
+                    logging.info(f"Throttled, concurrency limit now {int(self.limit)}")
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class FetchPolicy():
+    """ shared retry, rate limit and concurrency policy for one fhir server. every request waits for a
+        token and a concurrency slot; 429/5xx responses and connection errors are retried up to
+        max_retries times, waiting Retry-After when the server sends it (which pauses all requests to
+        the server) and otherwise exponential backoff with full jitter. throttled responses halve the
+        concurrency limit, which then grows back one request at a time
+    Example:
+        policy=FetchPolicy(rate=20, max_concurrency=10)
+        r=policy.execute('GET', lambda: session.get(url), resource='observation')
+    """
+
+    def __init__(self, rate:float=None, burst:float=None, max_retries:int=5, backoff_base:float=0.5,
+                 backoff_max:float=60, max_concurrency:int=10, min_concurrency:int=1, server:str=''):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AdaptiveConcurrency(max_concurrency, min_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.server = server
+
+    def backoff(self, attempt:int):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def execute(self, method:str, send, resource:str=''):
+        """calls send() (one http request) under the policy and returns the final response"""
+        statuses = retry_statuses if method == 'GET' else throttle_statuses
+        attempt = 0
+        while True:
+            self.bucket.take()
+            self.concurrency.acquire()
+            throttled = False
+            try:
+                r = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.concurrency.release()
+                # a POST that timed out may have been processed, so only GETs are retried
+                if attempt >= self.max_retries or (method != 'GET' and isinstance(e, requests.Timeout)):
+                    raise
+                http_retries.inc(resource=resource, reason=type(e).__name__)
+                time.sleep(self.backoff(attempt))
+                attempt = attempt + 1
+                continue
+            except Exception:
+                self.concurrency.release()
+                raise
+            throttled = r.status_code in throttle_statuses
+            if throttled:
+                http_throttled.inc(server=self.server)
+            self.concurrency.release(throttled)
+            if r.status_code not in statuses or attempt >= self.max_retries:
+                return r
+            retry_after = parseRetryAfter(r.headers.get('Retry-After'))
+            if retry_after is not None:
+                # the server asked everyone to wait, not just this request
+                self.bucket.pause(min(retry_after, self.backoff_max))
+            else:
+                time.sleep(self.backoff(attempt))
+            http_retries.inc(resource=resource, reason=r.status_code)
+            r.close()
+            attempt = attempt + 1
+
+
+class PageSizer():
+    """ _count per resource type for one server's searches. page_size is an int or a dict by resource type
+        (with an optional 'default'); None leaves the page size to the server. a search that needed another
+        page after a full one doubles its type's count, up to max_page_size. a server that sent fewer
+        entries than asked for while more pages remained caps the type's count at what it sent
+    Example:
+        sizer=PageSizer({'Observation': 200, 'default': 100})
+        sizer.count('observation')
+    """
+
+    def __init__(self, page_size=None, max_page_size:int=1000):
+        if isinstance(page_size, dict):
+            self.default = page_size.get('default')
+            self.counts = {k.lower(): v for k, v in page_size.items() if k != 'default'}
+        else:
+            self.default = page_size
+            self.counts = {}
+        self.max_page_size = max_page_size
+        self.caps = {}
+        self._lock = threading.Lock()
+
+    def count(self, resource:str):
+        with self._lock:
+            return self.counts.get(resource.lower(), self.default)
+
+    def observe(self, resource:str, requested:int, returned:int, has_next:bool):
+        """records one page of a search that asked for requested entries per page"""
+        if not requested or not has_next:
+            return
+        resource = resource.lower()
+        with self._lock:
+            current = self.counts.get(resource, self.default) or requested
+            if returned < requested:
+                if returned > 0: # server limit; asking for more only costs a bigger request
+                    self.caps[resource] = returned
+                    self.counts[resource] = min(current, returned)
+            else:
+                limit = min(self.caps.get(resource, self.max_page_size), self.max_page_size)
+                self.counts[resource] = max(current, min(requested * 2, limit))
+
+
+# one policy per server, shared by every FhirConnection to it
+_fetch_policies = {}
+_fetch_policies_lock = threading.Lock()
+_page_sizers = {}
+
+
+def getFetchPolicy(server:str, **kwargs):
+    """returns the FetchPolicy for a server (url_root_fhir), creating it with kwargs the first time"""
+    with _fetch_policies_lock:
+        policy = _fetch_policies.get(server)
+        if policy is None:
+            policy = _fetch_policies[server] = FetchPolicy(server=server, **kwargs)
+        return policy
+
+
+def getPageSizer(server:str, **kwargs):
+    """returns the PageSizer for a server (url_root_fhir), creating it with kwargs the first time"""
+    with _fetch_policies_lock:
+        sizer = _page_sizers.get(server)
+        if sizer is None:
+            sizer = _page_sizers[server] = PageSizer(**kwargs)
+        return sizer
@@ -1,12 +1,17 @@
 from enum import Enum
-import hvac
 import getpass
 import os
 import urllib.parse
 import yaml
 from projectconfig.definitions import ROOT_DIR
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from controllers.response_cache import ResponseCache
+from controllers.metrics import http_requests, http_seconds, http_bytes, http_errors, cache_responses, resourceFromUrl
+from controllers.fetch_policy import getFetchPolicy, getPageSizer
+import threading
+import time
 
 class FHIRInstance(Enum):
     HAPI_FHIR_PROD = "hapi_fhir_server_prod"
@@ -15,6 +20,60 @@ class FHIRInstance(Enum):
     EPIC_FHIR_NCAL_DEV = "kphc_fhir_server_dev"
     UPMC_FHIR_PROD = "upmc_fhir_server_prod"
 
+class CredentialStore():
+    """ process wide cache of the vault client and the secrets read through it. the client is built (and
+        checked with is_authenticated) once, and again only when the token file changes. each secret path
+        is read once and kept for ttl seconds or until invalidate(), eg after the fhir server answers 401
+    Example:
+        password=credential_store.read('user/path/to/secret')['password']
+    """
+
+    def __init__(self, token_path:str, url:str='password_manager_url', mount_point:str='mp', ttl:float=60*60):
+        self.token_path = token_path
+        self.url = url
+        self.mount_point = mount_point
+        self.ttl = ttl
+        self._client = None
+        self._token_mtime = None
+        self._secrets = {} # secret path -> (time read, data)
+        self._lock = threading.RLock()
+
+    def client(self):
+        with self._lock:
+            mtime = os.path.getmtime(self.token_path)
+            if self._client is None or mtime != self._token_mtime:
+                import hvac # only connections with vault credentials need it
+                with open(self.token_path, "r") as file:
+                    mytoken = file.readline().strip()
+                client = hvac.Client(
+                    url=self.url,
+                    token=mytoken)
+                # This line will check for a valid connection:
+                print(f'Valid Vault Connection?-->{client.is_authenticated()}')
+                client.secrets.kv.default_kv_version = 1
+                self._client, self._token_mtime = client, mtime
+            return self._client
+
+    def read(self, secret_path:str):
+        """data of a kv secret, from the cache while it is younger than ttl"""
+        with self._lock:
+            item = self._secrets.get(secret_path)
+            if item is not None and time.monotonic() - item[0] < self.ttl:
+                return item[1]
+            data = self.client().secrets.kv.read_secret(path=secret_path, mount_point=self.mount_point)['data']
+            self._secrets[secret_path] = (time.monotonic(), data)
+            return data
+
+    def invalidate(self, secret_path:str=None):
+        """drops one cached secret (or all of them) so the next read goes to vault"""
+        with self._lock:
+            if secret_path is None:
+                self._secrets.clear()
+            else:
+                self._secrets.pop(secret_path, None)
+
+credential_store = CredentialStore(os.path.join(ROOT_DIR, 'vault.token'))
+
 class FhirConnection():
 
     def __init__(self, FHIRInst: FHIRInstance):
@@ -22,35 +81,36 @@ class FhirConnection():
         self.establishConnection(self.FHIRInst)
 
     def getVaultClient(self):
-        with open(os.path.join(ROOT_DIR, 'vault.token'), "r") as file:
-            mytoken = file.readline().strip()
-        client = hvac.Client(
-            url='password_manager_url',
-            token=mytoken)
-        # This line will check for a valid connection:
-        print(f'Valid Vault Connection?-->{client.is_authenticated()}')
-        client.secrets.kv.default_kv_version = 1
-        return client
+        return credential_store.client()
+
+    def secretPath(self, secret_detail_path):
+        return f'{getpass.getuser().lower()}/{secret_detail_path}'
 
     def getAuthCredentials(self, secret_detail_path):
-        client = self.getVaultClient()
-        mount_point = 'mp'
-        secret_path = f'{getpass.getuser().lower()}/{secret_detail_path}'
-        vuser = client.secrets.kv.read_secret(path=secret_path, mount_point=mount_point)['data'][self.user_id_field]
-        vpass = client.secrets.kv.read_secret(path=secret_path, mount_point=mount_point)['data'][self.pwd_field]
-        return {'vuser': vuser, 'vpass': vpass}
+        # user and password come from one read of the secret
+        secret = credential_store.read(self.secretPath(secret_detail_path))
+        return {'vuser': secret[self.user_id_field], 'vpass': secret[self.pwd_field]}
 
     def getToken(self, secret_detail_path):
-        client = self.getVaultClient()
-        mount_point = 'mp'
-        secret_path = f'{getpass.getuser().lower()}/{secret_detail_path}'
-        token = client.secrets.kv.read_secret(path=secret_path, mount_point=mount_point)['data']['apikey']
+        token = credential_store.read(self.secretPath(secret_detail_path))['apikey']
         return token
 
+    @classmethod
+    def fromConfig(cls, configsection:dict, FHIRInst:FHIRInstance=None):
+        """ builds a connection from a config section dict (same keys as a fhirconfig.yaml section)
+            instead of reading fhirconfig.yaml, eg for a local test server with auth_type none
+        """
+        conn = cls.__new__(cls)
+        conn.FHIRInst = FHIRInst
+        conn.configure(configsection)
+        return conn
+
     def establishConnection(self, FHIRInst: FHIRInstance):
         with open(os.path.join(ROOT_DIR, 'fhirconfig.yaml')) as configfile:
             config = yaml.safe_load(configfile)
-        configsection = config[FHIRInst.value]
+        self.configure(config[FHIRInst.value])
+
+    def configure(self, configsection:dict):
         self.url_root_fhir = configsection.get("url_root_fhir")
         self.url_base_fhir=self.url_root_fhir+configsection.get("url2_fhir")
         # only epic has url_root_service -- the url for web service to get fhir id for a patient
@@ -59,20 +119,133 @@ class FhirConnection():
         except:
             self.url_root_service=None
         self.conn_type=configsection.get("conn_type")
+        # collapse each patient's searches into one batch Bundle POST (models.batch_fhir); on by default for hapi,
+        # epic has one endpoint per resource type and no base url to post a batch to
+        self.batch_queries = configsection.get("batch_queries", (self.conn_type or '').lower() == 'hapi')
+        # patient searches ask only for the elements the parsers read (_elements), or a _summary mode when
+        # search_elements is off; see models.getKPHCFHIR.searchParams
+        self.search_elements = configsection.get("search_elements", (self.conn_type or '').lower() == 'hapi')
+        self.search_summary = configsection.get("search_summary")
         self.reqkwargs = {}
-        self.reqkwargs['headers'] = configsection.get("headers")
+        self.reqkwargs['headers'] = dict(configsection.get("headers") or {})
 
-        if configsection.get("auth_type").lower() == "basic":
+        self.auth_type = (configsection.get("auth_type") or "none").lower()
+        self.api_vault_path = configsection.get("api_vault_path")
+        if self.auth_type == "basic":
             #set fields to get for passwords depending on environment
             self.user_id_field=configsection.get("user_id_field")
             self.pwd_field = configsection.get("pwd_field")
-            fhir_auth = self.getAuthCredentials(configsection.get("api_vault_path"))
-            self.reqkwargs['auth'] = HTTPBasicAuth(fhir_auth['vuser'], fhir_auth['vpass'])
-        elif configsection.get("auth_type").lower() == "token":
-            self.reqkwargs['headers']['x-api-key'] = self.getToken(configsection.get("api_vault_path"))
+        elif self.auth_type == "token":
             self.reqkwargs['verify'] = os.path.join(ROOT_DIR, 'gitlab-bundle.pem')
         else:
             pass
+        self.setCredentials()
+        self.createSession(configsection)
+
+    def setCredentials(self):
+        """ puts the basic auth or api key from vault (through credential_store) into reqkwargs and the session """
+        if self.auth_type == "basic":
+            fhir_auth = self.getAuthCredentials(self.api_vault_path)
+            self.reqkwargs['auth'] = HTTPBasicAuth(fhir_auth['vuser'], fhir_auth['vpass'])
+            if getattr(self, 'session', None) is not None:
+                self.session.auth = self.reqkwargs['auth']
+        elif self.auth_type == "token":
+            self.reqkwargs['headers']['x-api-key'] = self.getToken(self.api_vault_path)
+            if getattr(self, 'session', None) is not None:
+                self.session.headers['x-api-key'] = self.reqkwargs['headers']['x-api-key']
+
+    def refreshCredentials(self):
+        """ reads this connection's secret from vault again, eg after it was rotated """
+        if self.auth_type in ("basic", "token"):
+            credential_store.invalidate(self.secretPath(self.api_vault_path))
+            self.setCredentials()
+
+    def createSession(self, configsection:dict):
+        """ creates a pooled keep-alive session so every fhir call reuses open connections instead of
+            doing a new tcp+tls handshake. pool size and timeouts come from the optional
+            fhirconfig keys pool_connections, pool_maxsize, connect_timeout and read_timeout
+        """
+        self.timeout = (configsection.get("connect_timeout", 10), configsection.get("read_timeout", 120))
+        pool_maxsize = configsection.get("pool_maxsize", 10)
+        adapter = HTTPAdapter(pool_connections=configsection.get("pool_connections", 10), pool_maxsize=pool_maxsize)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # session carries the same headers/auth/verify that reqkwargs holds
+        self.session.headers.update(self.reqkwargs.get('headers') or {})
+        if 'auth' in self.reqkwargs:
+            self.session.auth = self.reqkwargs['auth']
+        if 'verify' in self.reqkwargs:
+            self.session.verify = self.reqkwargs['verify']
+        # retries, rate limit and adaptive concurrency, shared by every connection to this server
+        self.fetch_policy = getFetchPolicy(self.url_root_fhir, rate=configsection.get("rate_limit"),
+                                           burst=configsection.get("rate_burst"),
+                                           max_retries=configsection.get("max_retries", 5),
+                                           backoff_base=configsection.get("backoff_base", 0.5),
+                                           backoff_max=configsection.get("backoff_max", 60),
+                                           max_concurrency=configsection.get("max_concurrency", pool_maxsize))
+        # per resource _count, grown while the server honors it; hapi defaults to 100, epic to the server's page size
+        self.page_sizer = getPageSizer(self.url_root_fhir,
+                                       page_size=configsection.get("page_size", 100 if (self.conn_type or '').lower() == 'hapi' else None),
+                                       max_page_size=configsection.get("max_page_size", 1000))
+        # opt-in on-disk response cache with conditional revalidation
+        self.response_cache = None
+        if configsection.get("response_cache_path"):
+            self.response_cache = ResponseCache(os.path.join(ROOT_DIR, configsection.get("response_cache_path")),
+                                                max_bytes=configsection.get("response_cache_max_mb", 1024)*1024*1024,
+                                                max_age=configsection.get("response_cache_max_age", 0))
+
+    def get(self, url:str, resource:str=None, **kwargs):
+        """ GET through the pooled session. plain searches and reads go through response_cache when
+            it is set; requests with their own headers or stream=True always go to the server.
+            resource labels the request metrics (taken from the url when not given)
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        if self.response_cache is not None and kwargs.keys() == {'timeout'}:
+            return self.request('GET', url, resource, self.response_cache.get, self.session, url, **kwargs)
+        return self.request('GET', url, resource, self.session.get, url, **kwargs)
+
+    def post(self, url:str, resource:str=None, **kwargs):
+        """ POST through the pooled session """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.request('POST', url, resource, self.session.post, url, **kwargs)
+
+    def request(self, method:str, url:str, resource:str, send, *args, **kwargs):
+        """ sends one request under fetch_policy (rate limit, concurrency limit, retries) """
+        resource = resource or resourceFromUrl(url)
+        r = self.fetch_policy.execute(method, lambda: self.measure(method, resource, send, *args, **kwargs), resource)
+        if r.status_code == 401 and self.auth_type in ("basic", "token"):
+            # the cached secret may have been rotated; read it again and retry once
+            r.close()
+            self.refreshCredentials()
+            r = self.fetch_policy.execute(method, lambda: self.measure(method, resource, send, *args, **kwargs), resource)
+        return r
+
+    def measure(self, method:str, resource:str, send, *args, **kwargs):
+        """ calls send(*args, **kwargs) once and records request count, latency, status and body size.
+            responses from response_cache are counted by cache_responses; a hit sent no request and is
+            left out of the http metrics, and a revalidated entry counts as the 304 the server sent
+        """
+        start = time.perf_counter()
+        try:
+            r = send(*args, **kwargs)
+        except Exception as e:
+            http_errors.inc(resource=resource, error=type(e).__name__)
+            raise
+        cache_status = getattr(r, 'cache_status', None)
+        if cache_status is not None:
+            cache_responses.inc(resource=resource, cache=cache_status)
+        if cache_status == 'hit':
+            return r
+        http_seconds.observe(time.perf_counter() - start, resource=resource, method=method)
+        if cache_status == 'revalidated': # the stored body was not sent again
+            http_requests.inc(resource=resource, method=method, status=304)
+            return r
+        http_requests.inc(resource=resource, method=method, status=r.status_code)
+        # streamed bodies are not read here; count what the server says it is sending
+        size = int(r.headers.get('Content-Length') or 0) if kwargs.get('stream') else len(r.content)
+        http_bytes.inc(size, resource=resource)
+        return r
 
     def getUrl(self, resourcetype:str):
         """ this function gets the full url for a fhir endpoint given a resource type and the conn_type from fhirconfig
@@ -106,3 +279,20 @@ class FhirConnection():
         else:
             pass
         return urlnext
+
+
+# one connection per FHIRInstance, shared by every caller in the process
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def getFhirConnection(FHIRInst:FHIRInstance):
+    """returns the process's FhirConnection for FHIRInst, connecting (and reading vault) only the first time
+    Example:
+        conn=getFhirConnection(FHIRInstance.HAPI_FHIR_PROD)
+    """
+    with _connections_lock:
+        conn = _connections.get(FHIRInst)
+        if conn is None:
+            conn = _connections[FHIRInst] = FhirConnection(FHIRInst)
+        return conn
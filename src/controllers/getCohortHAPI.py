@@ -6,11 +6,15 @@ import models.parse_fhir as parse_fhir
 from controllers.fhir_connection import *
 
 start=datetime.datetime.now()
-def getHapiCohort(fhirconn:FhirConnection,n=10):
+def getHapiCohort(fhirconn:FhirConnection,n=10,start_date:str='2018-01-01',end_date:str='2022-01-31',random_state=None):
     """
-    Gets a cohort from HAPI that we can use to run through Seneca algorithm
+    Gets a cohort from HAPI that we can use to run through Seneca algorithm.
+    encounters are sampled first and MRNs are only resolved for the sampled rows, in batches
+    (getHapiMRNs), so a small n costs a handful of Patient searches instead of one read per encounter
     Args:
         n: number of records to return in dataframe
+        start_date, end_date: ED encounter date window (yyyy-mm-dd)
+        random_state: seed for the sample
     Returns:
         pandas dataframe: patid,pat_enc_csn_id, MRN, admit_datetime,dis_datetime,urn
     Example:
@@ -19,21 +23,24 @@ def getHapiCohort(fhirconn:FhirConnection,n=10):
     logging.basicConfig()
     logging.getLogger().setLevel(logging.INFO)
 
-    # call to fhir api to get all ed encounters for given dates
-    fhirobj=getEncounterED(fhirconn,start_date='2018-01-01', end_date='2022-01-31')
+    # call to fhir api to get all ed encounters for given dates; pages are parsed as they arrive
+    fhirobj=getEncounterED(fhirconn,start_date=start_date, end_date=end_date, stream=True)
     # parse encounters to get desired data
-    df = pd.concat([parse_fhir.parseEncProgInputs(x) for x in fhirobj])
-    # format dates 
+    df = pd.concat([parse_fhir.parseEncProgInputs(x) for x in fhirobj], ignore_index=True)
+    # encounters without a patient or start can not be scored
+    df = df[df['patid'].notna() & df['start_date'].notna()]
+    # get a sample of dataset before any per patient lookups
+    if n>len(df.index): #return full sample if n is greater than rows in dataset
+        n=len(df.index)
+    df = df.sample(n=n, random_state=random_state)
+    # format dates
     df['admit_datetime']=df['start_date']+ " +00:00"
     df['dis_datetime']=df['end_date']+ " +00:00"
     #add MRN to dataframe
-    df["MRN"] = [getHapiMRN(patid=x, fhirconn=fhirconn) for x in df.patid]
+    mrns = getHapiMRNs(list(df.patid), fhirconn=fhirconn)
+    df["MRN"] = [mrns.get(x) for x in df.patid]
     # drop unformatted date columns
     df.drop(columns=['start_date','end_date'], inplace=True)
-    # get a sample of dataset
-    if n>len(df.index): #return full sample if n is greater than rows in dataset
-        n=len(df.index)
-    df = df.sample(n=n)
     #print timing
     end = datetime.datetime.now()
     start_time = start.strftime("%H:%M:%S")
@@ -44,4 +51,4 @@ def getHapiCohort(fhirconn:FhirConnection,n=10):
     return(df)
 
 if __name__ == "__main__":
-    df2=getHapiCohort(n=1000)
+    df2=getHapiCohort(getFhirConnection(FHIRInstance.HAPI_FHIR_PROD),n=1000)
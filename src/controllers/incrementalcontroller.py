@@ -0,0 +1,197 @@
+import copy
+import datetime
+import hashlib
+import logging
+import os
+import pickle
+import pandas as pd
+from models.getKPHCFHIR import *
+from models.seneca import *
+from models.bulk_fhir import toBundle
+import models.parse_fhir as parse_fhir
+from controllers.fhir_connection import *
+from controllers.metrics import pipeline_errors
+from controllers.senecacontroller import getEncounterWindow, getFhirId, getValuesets, getSenecaLoincs
+
+# searches whose results are kept per patient; vitals and labs are both Observation categories
+incremental_searches = ['vital-signs', 'laboratory', 'MedicationRequest', 'Condition']
+
+# how far the _lastUpdated checkpoint is set back from the server's time, for resources committed with
+# a lastUpdated just before the search ran. resources are merged by id, so anything fetched twice just
+# replaces itself
+checkpoint_overlap = datetime.timedelta(minutes=5)
+
+
+class PatientStateStore():
+    """ one pickle per cohort row (patient + encounter window) under state_dir holding the fhir id,
+        the last _lastUpdated checkpoint, every resource fetched so far (by search, keyed by
+        resource id) and the last seneca input and score rows
+    Example:
+        store=PatientStateStore('seneca_state/')
+    """
+
+    def __init__(self, state_dir:str):
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+
+    def key(self, row):
+        return hashlib.sha1(f'{row["MRN"]}|{row["admit_datetime"]}'.encode('utf-8')).hexdigest()
+
+    def load(self, key:str):
+        path = os.path.join(self.state_dir, key + '.pkl')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, key:str, state:dict):
+        # write then rename so an interrupted run never leaves a half written state file
+        path = os.path.join(self.state_dir, key + '.pkl')
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+
+def _serverTime(value:str):
+    # fhir instant -> timezone aware datetime, None when missing or not an instant
+    try:
+        instant = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return instant if instant.tzinfo is not None else instant.replace(tzinfo=datetime.timezone.utc)
+
+
+def _mergePages(resources:dict, pages, times:dict):
+    """adds the entry resources of fetched pages to resources (id -> resource); returns how many arrived.
+    the search's time (first page's meta.lastUpdated) is appended to times['searched'] and
+    times['newest'] is raised to the newest meta.lastUpdated merged"""
+    n = 0
+    for i, page in enumerate(pages):
+        if i == 0:
+            times['searched'].append(_serverTime((page.get('meta') or {}).get('lastUpdated')))
+        for entry in page.get('entry') or []:
+            resource = entry.get('resource') or {}
+            # medrequest sometimes has admin statements at end that are of type OperationOutcome
+            if resource.get('resourceType') == 'OperationOutcome':
+                continue
+            resources[resource.get('id')] = resource
+            updated = _serverTime((resource.get('meta') or {}).get('lastUpdated'))
+            if updated is not None and (times['newest'] is None or updated > times['newest']):
+                times['newest'] = updated
+            n = n + 1
+    return n
+
+
+def _checkpoint(times:dict, since:str):
+    """next _lastUpdated checkpoint from the server's clock: the earliest search time when every search
+    reported one, otherwise the newest lastUpdated merged, otherwise the current checkpoint"""
+    if times['searched'] and None not in times['searched']:
+        server_time = min(times['searched'])
+    elif times['newest'] is not None:
+        server_time = times['newest']
+    else:
+        return since
+    return (server_time - checkpoint_overlap).astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _bundles(resources:dict, strict:bool):
+    # the strict Observation parser patches issued in place, so it gets a copy of the stored state
+    bundle = toBundle(list(resources.values()))
+    return [copy.deepcopy(bundle) if strict else bundle]
+
+
+def getPatientIncremental(row, fhirconn:FhirConnection, store:PatientStateStore, strict:bool=True):
+    """fetches only the resources changed since this row's last checkpoint, merges them into its
+    stored state and rebuilds the seneca input row only when something changed. the checkpoint moves
+    to the server's time of this fetch only when all four searches finished; after a failed one the
+    next run asks again from the old checkpoint
+    Returns:
+        (df_seneca, df_score, changed) where df_score is the stored score when nothing changed
+    """
+    key = store.key(row)
+    state = store.load(key)
+    admit_datetime, start_date_txt, end_date_txt = getEncounterWindow(row)
+    if state is None:
+        fhir_id = getFhirId(row, fhirconn)
+        state = {'fhir_id': fhir_id, 'checkpoint': None, 'patient': getPatient(patID=fhir_id, fhirconn=fhirconn),
+                 'resources': {search: {} for search in incremental_searches}, 'seneca': None, 'score': None}
+    fhir_id = state['fhir_id']
+    since = state['checkpoint']
+
+    changed = since is None
+    complete = True
+    times = {'searched': [], 'newest': None}
+    def merge(search, pages):
+        # pages are fetched as they are merged, so a failed page raises here
+        nonlocal complete
+        try:
+            return _mergePages(state['resources'][search], pages, times)
+        except Exception as e:
+            # what arrived is kept; the checkpoint stays so the missed pages are asked for again
+            pipeline_errors.inc(stage='incremental')
+            logging.exception(f"Incomplete {search} search for {fhir_id}: {e}")
+            complete = False
+            return 0
+
+    for category in ['vital-signs', 'laboratory']:
+        pages = getObservation(patID=fhir_id, category=category, fhirconn=fhirconn, start_date=start_date_txt,
+                               end_date=end_date_txt, stream=True, since=since, raise_errors=True)
+        changed = merge(category, pages) > 0 or changed
+    pages = getMedicationRequest(patID=fhir_id, fhirconn=fhirconn, start_date=start_date_txt, end_date=end_date_txt,
+                                 stream=True, since=since, raise_errors=True)
+    # MedicationRequests are kept in the state but are not a seneca input, so they never force a rescore
+    merge('MedicationRequest', pages)
+    pages = getCondition(patID=fhir_id, fhirconn=fhirconn, start_date=start_date_txt, end_date=end_date_txt,
+                         stream=True, since=since, raise_errors=True)
+    changed = merge('Condition', pages) > 0 or changed
+    if complete:
+        state['checkpoint'] = _checkpoint(times, since)
+
+    if changed or state['seneca'] is None:
+        resources = state['resources']
+        df_pat = parse_fhir.parsePatient(state['patient'], strict=strict)
+        df_obs_vitals = pd.concat([parse_fhir.parseObservation(x, getValuesets(), strict=strict) for x in _bundles(resources['vital-signs'], strict)])
+        df_obs_labs = pd.concat([parse_fhir.parseObservation(x, getValuesets(), strict=strict) for x in _bundles(resources['laboratory'], strict)])
+        df_conds = pd.concat([parse_fhir.parseCondition(x, strict=strict) for x in _bundles(resources['Condition'], strict)])
+        state['seneca'] = getSenecaData(dfPat=df_pat, dfLabs=df_obs_labs, dfVitals=df_obs_vitals, dfConds=df_conds,
+                                        dfSenecaList=getSenecaLoincs(), enctr_date=start_date_txt)
+        state['score'] = None
+        changed = True
+    store.save(key, state)
+    return state['seneca'], state['score'], changed
+
+
+def senecaControlIncremental(df:pd.DataFrame, fhirconn:FhirConnection, state_dir:str, strict:bool=True):
+    """repeat-run version of senecaControl. each row only asks the server for resources changed since
+    its last run (_lastUpdated), and only rows whose inputs changed are re-scored.
+    resources deleted on the server are not seen by _lastUpdated searches and stay in the state;
+    delete the row's state file to force a full refetch
+    Returns:
+        list of one row seneca score dataframes, in cohort order
+    """
+    start=datetime.datetime.now()
+    store = PatientStateStore(state_dir)
+    results = [] # (key, df_seneca, df_score) per row that could be processed
+    for index, row in df.iterrows():
+        try:
+            df_seneca, df_score, changed = getPatientIncremental(row, fhirconn, store, strict)
+            results.append((store.key(row), df_seneca, None if changed else df_score))
+        except Exception as e:
+            pipeline_errors.inc(stage='incremental')
+            logging.exception(f"Error: {e}")
+
+    # score only the rows that changed, all together, and keep their scores for the next run
+    rescore = [i for i, (key, df_seneca, df_score) in enumerate(results) if df_score is None]
+    logging.info(f"Rescoring {len(rescore)} of {len(results)} patients")
+    if len(rescore) > 0:
+        df_scores = senecaScoreBatch(pd.concat([results[i][1] for i in rescore]))
+        for n, i in enumerate(rescore):
+            key, df_seneca, df_score = results[i]
+            df_score = df_scores.iloc[[n]]
+            state = store.load(key)
+            state['score'] = df_score
+            store.save(key, state)
+            results[i] = (key, df_seneca, df_score)
+    end=datetime.datetime.now()
+    print('process time:', end-start)
+    return [df_score for key, df_seneca, df_score in results]
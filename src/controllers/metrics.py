@@ -0,0 +1,294 @@
+import bisect
+import collections
+import functools
+import json
+import math
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds; covers a cached read through a slow paged search
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labelKey(labelnames:tuple, labels:dict):
+    return tuple(str(labels.get(name, '')) for name in labelnames)
+
+
+def _labelText(labelnames:tuple, key:tuple, extra:str=''):
+    parts = [f'{name}="{value}"' for name, value in zip(labelnames, key)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Counter():
+    """monotonic count per label set"""
+    kind = 'counter'
+
+    def __init__(self, name:str, help:str, labelnames:tuple=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount:float=1, **labels):
+        key = _labelKey(self.labelnames, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def prometheus(self):
+        with self._lock:
+            return [f'{self.name}{_labelText(self.labelnames, key)} {value}' for key, value in sorted(self.values.items())]
+
+    def toDict(self):
+        with self._lock:
+            return [dict(zip(self.labelnames, key), value=value) for key, value in sorted(self.values.items())]
+
+    def reset(self):
+        with self._lock:
+            self.values = {}
+
+
+class Histogram():
+    """count, sum and bucket counts of observed values (eg seconds) per label set"""
+    kind = 'histogram'
+
+    def __init__(self, name:str, help:str, labelnames:tuple=(), buckets:tuple=default_buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {} # label key -> [per bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value:float, **labels):
+        key = _labelKey(self.labelnames, labels)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        """context manager that observes the seconds its block took"""
+        return _Timer(self, labels)
+
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, n in zip(list(self.buckets) + ['+Inf'], counts):
+                    cumulative += n
+                    le = 'le="' + str(bound) + '"'
+                    lines.append(f'{self.name}_bucket{_labelText(self.labelnames, key, le)} {cumulative}')
+                lines.append(f'{self.name}_sum{_labelText(self.labelnames, key)} {total}')
+                lines.append(f'{self.name}_count{_labelText(self.labelnames, key)} {count}')
+        return lines
+
+    def toDict(self):
+        with self._lock:
+            return [dict(zip(self.labelnames, key), count=count, sum=total,
+                         buckets=dict(zip([str(x) for x in self.buckets] + ['+Inf'], counts)))
+                    for key, (counts, total, count) in sorted(self.values.items())]
+
+    def reset(self):
+        with self._lock:
+            self.values = {}
+
+
+class Summary():
+    """count, sum and quantiles (eg p50/p99) of the last window observed values per label set"""
+    kind = 'summary'
+
+    def __init__(self, name:str, help:str, labelnames:tuple=(), quantiles:tuple=(0.5, 0.9, 0.99), window:int=10000):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.quantiles = tuple(quantiles)
+        self.window = window
+        self.values = {} # label key -> [recent values, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value:float, **labels):
+        key = _labelKey(self.labelnames, labels)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [collections.deque(maxlen=self.window), 0.0, 0]
+            entry[0].append(value)
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def quantile(self, q:float, **labels):
+        """q quantile (nearest rank) of the recent values; None before the first observation"""
+        with self._lock:
+            entry = self.values.get(_labelKey(self.labelnames, labels))
+            recent = sorted(entry[0]) if entry is not None else []
+        return _nearestRank(recent, q)
+
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            items = [(key, sorted(recent), total, count) for key, (recent, total, count) in sorted(self.values.items())]
+        for key, recent, total, count in items:
+            for q in self.quantiles:
+                quantile = 'quantile="' + str(q) + '"'
+                lines.append(f'{self.name}{_labelText(self.labelnames, key, quantile)} {_nearestRank(recent, q)}')
+            lines.append(f'{self.name}_sum{_labelText(self.labelnames, key)} {total}')
+            lines.append(f'{self.name}_count{_labelText(self.labelnames, key)} {count}')
+        return lines
+
+    def toDict(self):
+        with self._lock:
+            items = [(key, sorted(recent), total, count) for key, (recent, total, count) in sorted(self.values.items())]
+        return [dict(zip(self.labelnames, key), count=count, sum=total,
+                     quantiles={str(q): _nearestRank(recent, q) for q in self.quantiles})
+                for key, recent, total, count in items]
+
+    def reset(self):
+        with self._lock:
+            self.values = {}
+
+
+def _nearestRank(ordered:list, q:float):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+class _Timer():
+    def __init__(self, histogram:Histogram, labels:dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class MetricsRegistry():
+    """ the pipeline's counters and histograms. export with prometheus() (text exposition format),
+        toJson()/writeJson(path) at the end of a run, or serve(port) for a /metrics endpoint.
+        metrics are per process; parses done in ParseStage worker processes are not counted
+    Example:
+        metrics.writeJson('seneca_metrics.json')
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            self.metrics.setdefault(metric.name, metric)
+            return self.metrics[metric.name]
+
+    def counter(self, name:str, help:str, labelnames:tuple=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name:str, help:str, labelnames:tuple=(), buckets:tuple=default_buckets):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def summary(self, name:str, help:str, labelnames:tuple=(), quantiles:tuple=(0.5, 0.9, 0.99), window:int=10000):
+        return self._register(Summary(name, help, labelnames, quantiles, window))
+
+    def prometheus(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.prometheus())
+        return '\n'.join(lines) + '\n'
+
+    def toJson(self):
+        return {name: {'type': metric.kind, 'help': metric.help, 'values': metric.toDict()}
+                for name, metric in list(self.metrics.items())}
+
+    def writeJson(self, path:str):
+        with open(path, 'w') as f:
+            json.dump(self.toJson(), f, indent=2)
+
+    def writePrometheus(self, path:str):
+        with open(path, 'w') as f:
+            f.write(self.prometheus())
+
+    def reset(self):
+        for metric in list(self.metrics.values()):
+            metric.reset()
+
+    def serve(self, port:int=9108, host:str='0.0.0.0'):
+        """serves GET /metrics (prometheus text) and /metrics.json on a daemon thread; returns the server"""
+        registry = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/metrics.json'):
+                    body, content_type = json.dumps(registry.toJson()).encode('utf-8'), 'application/json'
+                elif self.path.startswith('/metrics'):
+                    body, content_type = registry.prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+metrics = MetricsRegistry()
+
+http_requests = metrics.counter('fhir_http_requests_total', 'FHIR HTTP requests by resource type, method and status', ('resource', 'method', 'status'))
+http_seconds = metrics.histogram('fhir_http_request_seconds', 'FHIR HTTP request latency in seconds', ('resource', 'method'))
+http_bytes = metrics.counter('fhir_http_response_bytes_total', 'FHIR response body bytes received', ('resource',))
+http_errors = metrics.counter('fhir_http_errors_total', 'FHIR requests that raised before a response', ('resource', 'error'))
+cache_responses = metrics.counter('fhir_response_cache_total', 'GETs through the response cache by outcome (hit: answered without a request)', ('resource', 'cache'))
+pages_fetched = metrics.counter('fhir_pages_total', 'searchset pages fetched', ('resource',))
+parse_seconds = metrics.histogram('parse_seconds', 'time spent in each parse_fhir parser per call', ('parser',))
+parse_errors = metrics.counter('parse_errors_total', 'parser calls that failed and returned no rows', ('parser',))
+medication_lookups = metrics.counter('medication_lookups_total', 'Medication ids resolved, by where they came from', ('source',))
+score_seconds = metrics.histogram('score_seconds', 'senecaScoreBatch time per call')
+scored_patients = metrics.counter('scored_patients_total', 'patients scored')
+pipeline_errors = metrics.counter('pipeline_errors_total', 'cohort rows that failed, by stage', ('stage',))
+
+
+def timed(histogram:Histogram, **labels):
+    """decorator that observes each call's seconds in histogram"""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def resourceFromUrl(url:str):
+    """lower case fhir resource type of a request url (patient, observation, ...). epic urls look like
+    .../epicfhirobservation/r4; hapi paging urls (/fhir?_getpages=) carry no type and give 'page'"""
+    segments = [x for x in urllib.parse.urlsplit(url).path.split('/') if x]
+    for n, segment in enumerate(segments):
+        if segment.lower().startswith('epicfhir'):
+            return segment[len('epicfhir'):].split('&')[0].lower() or 'page'
+        if segment.lower() == 'fhir':
+            if n + 1 < len(segments):
+                return segments[n + 1].split('&')[0].lstrip('$').lower() or 'page'
+            return 'page'
+    return segments[-1].split('&')[0].lower() if segments else 'unknown'
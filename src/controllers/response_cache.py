@@ -0,0 +1,117 @@
+import json
+import sqlite3
+import threading
+import time
+import urllib.parse
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+def normalizeUrl(url:str):
+    """ lower cases scheme and host and sorts the query parameters so the same search built in a
+        different order maps to the same cache entry
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)), safe=',:')
+    return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+
+class ResponseCache():
+    """ opt-in on-disk cache of fhir GET responses in a sqlite file, keyed by the normalized url.
+        ETag and Last-Modified are stored with each body and sent back as If-None-Match /
+        If-Modified-Since, so an unchanged resource costs a 304 instead of a full download.
+        responses younger than max_age seconds are served without asking the server at all.
+        when the stored bodies exceed max_bytes the least recently used entries are evicted.
+        every response get returns has cache_status 'hit' (no request sent), 'revalidated' (the server
+        answered 304) or 'miss', so FhirConnection.measure can keep hits out of the http metrics
+    Example:
+        conn.response_cache = ResponseCache('fhir_cache.sqlite', max_bytes=2*1024**3)
+    """
+
+    def __init__(self, path:str, max_bytes:int=1024**3, max_age:float=0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""create table if not exists response (
+                              key text primary key, etag text, last_modified text, headers text,
+                              body blob, size integer, stored_at real, accessed_at real)""")
+        self._db.execute("create index if not exists response_accessed on response (accessed_at)")
+        self._db.commit()
+
+    def lookup(self, url:str):
+        """returns the stored entry for url as a dict or None"""
+        with self._lock:
+            row = self._db.execute("select etag, last_modified, headers, body, stored_at from response where key=?",
+                                   (normalizeUrl(url),)).fetchone()
+        if row is None:
+            return None
+        return {'etag': row[0], 'last_modified': row[1], 'headers': json.loads(row[2]), 'body': row[3], 'stored_at': row[4]}
+
+    def store(self, url:str, response:requests.Response):
+        now = time.time()
+        body = response.content
+        with self._lock:
+            self._db.execute("insert or replace into response values (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (normalizeUrl(url), response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                              json.dumps(dict(response.headers)), body, len(body), now, now))
+            self._evict()
+            self._db.commit()
+
+    def touch(self, url:str, refreshed:bool=False):
+        """marks an entry as used; refreshed=True also restarts its max_age (after a 304)"""
+        now = time.time()
+        with self._lock:
+            if refreshed:
+                self._db.execute("update response set accessed_at=?, stored_at=? where key=?", (now, now, normalizeUrl(url)))
+            else:
+                self._db.execute("update response set accessed_at=? where key=?", (now, normalizeUrl(url)))
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute("select coalesce(sum(size), 0) from response").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute("select key, size from response order by accessed_at").fetchall():
+            self._db.execute("delete from response where key=?", (key,))
+            total = total - size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("delete from response")
+            self._db.commit()
+
+    def get(self, session:requests.Session, url:str, **kwargs):
+        """GET through the cache: fresh entries are served directly, stale ones are revalidated"""
+        entry = self.lookup(url)
+        if entry is not None and self.max_age and time.time() - entry['stored_at'] < self.max_age:
+            self.touch(url)
+            return self._response(url, entry, 'hit')
+        headers = {}
+        if entry is not None:
+            if entry['etag'] is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified'] is not None:
+                headers['If-Modified-Since'] = entry['last_modified']
+        r = session.get(url, headers=headers, **kwargs)
+        if r.status_code == 304 and entry is not None:
+            self.touch(url, refreshed=True)
+            return self._response(url, entry, 'revalidated')
+        if r.status_code == 200:
+            self.store(url, r)
+        r.cache_status = 'miss'
+        return r
+
+    def _response(self, url:str, entry:dict, cache_status:str):
+        # rebuild a requests.Response from a stored entry so callers can keep using r.json()
+        r = requests.Response()
+        r.status_code = 200
+        r.url = url
+        r.headers = CaseInsensitiveDict(entry['headers'])
+        r._content = entry['body']
+        r.encoding = 'utf-8'
+        r.cache_status = cache_status
+        return r
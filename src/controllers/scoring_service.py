@@ -0,0 +1,311 @@
+import datetime
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import models.parse_fhir as parse_fhir
+from models.seneca import senecaScoreBatch, getElixhauserEngine
+from models.parse_pool import ParseStage
+from models.feature_state import FeatureStateStore
+from controllers.fhir_connection import *
+from controllers.metrics import metrics, pipeline_errors
+from controllers.senecacontroller import getPatientSenecaData, getPatientInputs, getEncounterWindow, getValuesets, getSenecaLoincs
+
+service_seconds = metrics.summary('service_score_seconds', 'notification to phenotype latency of the scoring service', ('outcome',))
+service_requests = metrics.counter('service_requests_total', 'encounters and updates the scoring service was asked to score, by how', ('source',))
+
+
+def _instantText(value:str):
+    # fhir instant -> the "YYYY-MM-DD HH:MM:SS +0000" form cohort rows use (getEncounterWindow)
+    if not value:
+        return None
+    instant = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if instant.tzinfo is None:
+        instant = instant.replace(tzinfo=datetime.timezone.utc)
+    return instant.astimezone(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S %z')
+
+
+def _reference(resource:dict, name:str):
+    # id of a resource's subject/encounter reference
+    return ((resource.get(name) or {}).get('reference') or '').split('/')[-1] or None
+
+
+def encounterRow(encounter:dict):
+    """cohort row (fhir_id, pat_enc_csn_id, admit_datetime, dis_datetime) for an Encounter resource"""
+    period = encounter.get('period') or {}
+    return {'fhir_id': _reference(encounter, 'subject'),
+            'pat_enc_csn_id': encounter.get('id'),
+            'admit_datetime': _instantText(period.get('start')),
+            'dis_datetime': _instantText(period.get('end'))}
+
+
+def notificationEncounters(bundle:dict):
+    """Encounter resources or 'Encounter/<id>' references in a subscription notification (or any) Bundle.
+    an empty body, like an R4 rest-hook ping without payload, has none"""
+    encounters = []
+    for entry in (bundle or {}).get('entry') or []:
+        resource = entry.get('resource') or {}
+        if resource.get('resourceType') == 'Encounter':
+            encounters.append(resource)
+        elif not resource and 'Encounter/' in (entry.get('fullUrl') or ''):
+            # id-only payload
+            encounters.append('Encounter/' + entry['fullUrl'].split('Encounter/', 1)[1].split('/_history')[0])
+    return encounters
+
+
+def notificationUpdates(bundle:dict):
+    """Observation and Condition resources, or their 'Observation/<id>' / 'Condition/<id>' references, in a
+    subscription notification Bundle"""
+    updates = []
+    for entry in (bundle or {}).get('entry') or []:
+        resource = entry.get('resource') or {}
+        if resource.get('resourceType') in ('Observation', 'Condition'):
+            updates.append(resource)
+        elif not resource:
+            for resourcetype in ('Observation', 'Condition'):
+                if f'{resourcetype}/' in (entry.get('fullUrl') or ''):
+                    updates.append(f'{resourcetype}/' + entry['fullUrl'].split(f'{resourcetype}/', 1)[1].split('/_history')[0])
+    return updates
+
+
+class ScoringService():
+    """ long-running seneca scoring for single encounters, eg ED arrivals. an encounter (an Encounter
+        resource, a Reference or 'Encounter/<id>') is fetched and scored with the same getPatientSenecaData
+        path as senecaControl on warm pools, connections and caches, and the result is returned when it is
+        ready within budget seconds and handed to publish either way.
+        serve() takes POST /score (wait for the phenotype), POST /notification (fhir subscription
+        notification Bundles, acknowledged at once and scored in the background) and GET /latency
+        (p50/p99 of the last scores); controllers.metrics has the same numbers as service_score_seconds.
+        with a FeatureStateStore every scored encounter stays open in it and a notified Observation or
+        Condition of its patient only updates that state and rescores the one row, without any fetch
+    Args:
+        fhirconn: connection the inputs are fetched with (one shared session; see getFhirConnection)
+        max_workers: encounters scored at the same time
+        budget: seconds POST /score waits before answering 202 and leaving the result to publish
+        publish: called with every result dict, eg to post it to a clinical system or a ColumnarWriter
+        state: FeatureStateStore the encounters are kept in for updates (snapshotted on stop() when it has a
+            snapshot_path); finished encounters are dropped from it after their score
+    Example:
+        service=ScoringService(getFhirConnection(FHIRInstance.HAPI_FHIR_PROD), publish=print).start()
+        service.serve(port=8088)
+    """
+
+    def __init__(self, fhirconn:FhirConnection, max_workers:int=4, strict:bool=True, parser:ParseStage=None,
+                 budget:float=60.0, publish=None, state:FeatureStateStore=None):
+        self.fhirconn = fhirconn
+        self.max_workers = max_workers
+        self.strict = strict
+        self.parser = parser
+        self.budget = budget
+        self.publish = publish
+        self.state = state
+        self.patient_pool = None
+        self.resource_pool = None
+        self.httpd = None
+
+    def start(self):
+        """starts the pools and does the one-time work (reference tables, loinc index, elixhauser tables,
+        fhir.resources import, first connection) before the first encounter arrives"""
+        self.patient_pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.resource_pool = ThreadPoolExecutor(max_workers=self.max_workers*5)
+        parse_fhir.getLoincIndex(getValuesets())
+        getSenecaLoincs()
+        getElixhauserEngine()
+        if self.strict:
+            parse_fhir.loadFhirResources()
+        try: # opens a pooled connection (and tls session) to the server
+            self.fhirconn.get(self.fhirconn.url_base_fhir + '/metadata').close()
+        except Exception as e:
+            logging.warning(f"Could not reach {self.fhirconn.url_base_fhir}: {e}")
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+        for pool in (self.patient_pool, self.resource_pool):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        self.patient_pool = self.resource_pool = None
+        if self.state is not None and self.state.snapshot_path is not None:
+            self.state.snapshot()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def getEncounter(self, encounter):
+        """Encounter resource for a resource, a Reference dict or an 'Encounter/<id>' string"""
+        if isinstance(encounter, dict) and encounter.get('resourceType') == 'Encounter':
+            return encounter
+        reference = encounter.get('reference') if isinstance(encounter, dict) else encounter
+        geturl = self.fhirconn.getUrl(resourcetype="Encounter") + '/' + str(reference).split('/')[-1]
+        r = self.fhirconn.get(geturl)
+        response = r.json()
+        if response.get('resourceType') != 'Encounter':
+            raise Exception(f"Could not get {reference}: {r.status_code}")
+        return response
+
+    def score(self, encounter, received:float=None):
+        """fetches and scores one encounter on the calling thread and returns the result dict"""
+        received = received or time.monotonic()
+        result = {'encounter': None, 'patient': None}
+        try:
+            encounter = self.getEncounter(encounter)
+            row = encounterRow(encounter)
+            result.update(encounter=row['pat_enc_csn_id'], patient=row['fhir_id'])
+            if self.state is None:
+                df_seneca = getPatientSenecaData(row, self.fhirconn, self.resource_pool, strict=self.strict, parser=self.parser)
+                self._scored(result, senecaScoreBatch(df_seneca))
+            else:
+                df_pat, df_obs_vitals, df_obs_labs, df_meds, df_conds, start_date_txt = getPatientInputs(
+                    row, self.fhirconn, self.resource_pool, strict=self.strict, parser=self.parser)
+                # an open encounter's window has no end yet; getEncounterWindow would end it today
+                end_date_txt = getEncounterWindow(row)[2] if row['dis_datetime'] else None
+                self.state.open(row['fhir_id'], row['pat_enc_csn_id'], df_pat, start_date_txt, df_obs_vitals, df_obs_labs, df_conds,
+                                end_date=end_date_txt)
+                self._scored(result, self.state.score(row['fhir_id'], row['pat_enc_csn_id']))
+                if encounter.get('status') in ('finished', 'cancelled', 'entered-in-error'):
+                    self.state.close(row['fhir_id'], row['pat_enc_csn_id'])
+        except Exception as e:
+            pipeline_errors.inc(stage='service')
+            logging.exception(f"Error scoring {result['encounter'] or encounter}: {e}")
+            result.update(status='error', error=str(e))
+        return self._finish(result, received)
+
+    def update(self, resource, received:float=None):
+        """folds one Observation or Condition (a resource or 'Observation/<id>') into the state of its
+        encounter (or of every open encounter of its patient when it names none) and rescores the encounters
+        whose inputs changed. a resource of an encounter that is not open is dropped, and so is an
+        Observation dated outside the encounter's window. returns the result dicts"""
+        received = received or time.monotonic()
+        try:
+            if isinstance(resource, str):
+                r = self.fhirconn.get(self.fhirconn.getUrl(resourcetype=resource.split('/')[0]) + '/' + resource.split('/')[-1])
+                resource = r.json()
+            patient, encounter = _reference(resource, 'subject'), _reference(resource, 'encounter')
+            if encounter is None:
+                encounters = self.state.encounters(patient)
+            elif encounter in self.state.encounters(patient):
+                encounters = [encounter]
+            else: # another encounter of the patient, finished or never scored here
+                encounters = []
+            changed = []
+            for encounter in encounters:
+                if resource.get('resourceType') == 'Observation':
+                    updated = self.state.addObservation(patient, encounter, resource)
+                else:
+                    updated = self.state.addCondition(patient, encounter, resource)
+                if updated:
+                    changed.append(encounter)
+        except Exception as e:
+            pipeline_errors.inc(stage='service')
+            logging.exception(f"Error updating from {resource}: {e}")
+            return []
+        results = []
+        for encounter in changed:
+            result = {'encounter': encounter, 'patient': patient}
+            try:
+                self._scored(result, self.state.score(patient, encounter))
+            except Exception as e:
+                pipeline_errors.inc(stage='service')
+                logging.exception(f"Error rescoring {encounter}: {e}")
+                result.update(status='error', error=str(e))
+            results.append(self._finish(result, received))
+        return results
+
+    def _scored(self, result:dict, df_score):
+        scores = df_score.iloc[0]
+        result.update(status='scored', phenotype=scores['phenotype'],
+                      distances={x: float(scores['dist.' + x]) for x in ['alpha', 'beta', 'gamma', 'delta']})
+
+    def _finish(self, result:dict, received:float):
+        seconds = time.monotonic() - received
+        service_seconds.observe(seconds, outcome=result['status'])
+        result.update(seconds=round(seconds, 4), within_budget=seconds <= self.budget)
+        if self.publish is not None:
+            try:
+                self.publish(result)
+            except Exception as e:
+                logging.exception(f"Could not publish {result['encounter']}: {e}")
+        return result
+
+    def submit(self, encounter, source:str='api'):
+        """queues an encounter for scoring and returns the future of its result dict"""
+        service_requests.inc(source=source)
+        return self.patient_pool.submit(self.score, encounter, time.monotonic())
+
+    def submitUpdate(self, resource):
+        """queues an Observation or Condition update and returns the future of its result dicts"""
+        service_requests.inc(source='update')
+        return self.patient_pool.submit(self.update, resource, time.monotonic())
+
+    def latency(self):
+        """p50/p99 seconds and count of the recent scores"""
+        scored = {'p50': service_seconds.quantile(0.5, outcome='scored'), 'p99': service_seconds.quantile(0.99, outcome='scored')}
+        counts = {x['outcome']: x['count'] for x in service_seconds.toDict()}
+        return dict(scored, count=counts.get('scored', 0), errors=counts.get('error', 0), budget=self.budget)
+
+    def serve(self, port:int=8088, host:str='0.0.0.0'):
+        """serves the http api on a daemon thread and returns the server"""
+        service = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                    body = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    self.reply(400, {'error': 'body is not json'})
+                    return
+                if self.path.startswith('/score'):
+                    # {"encounter": "Encounter/123"}, an Encounter resource or a Reference
+                    future = service.submit(body.get('encounter', body) if isinstance(body, dict) else body)
+                    try:
+                        self.reply(200, future.result(timeout=service.budget))
+                    except TimeoutError:
+                        self.reply(202, {'status': 'pending', 'budget': service.budget})
+                elif self.path.startswith('/notification'):
+                    encounters = notificationEncounters(body)
+                    for encounter in encounters:
+                        service.submit(encounter, source='notification')
+                    # new results of encounters already in the state; ignored without one
+                    updates = notificationUpdates(body) if service.state is not None else []
+                    for resource in updates:
+                        service.submitUpdate(resource)
+                    self.reply(200, {'queued': len(encounters) + len(updates)})
+                else:
+                    self.reply(404, {'error': f'unknown path {self.path}'})
+            def do_GET(self):
+                if self.path.startswith('/latency'):
+                    self.reply(200, service.latency())
+                elif self.path.startswith('/health'):
+                    self.reply(200, {'status': 'ok'})
+                else:
+                    self.reply(404, {'error': f'unknown path {self.path}'})
+            def reply(self, status, body):
+                data = json.dumps(body, default=str).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            def log_message(self, format, *args):
+                pass
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self.httpd
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    metrics.serve(port=9108)
+    service = ScoringService(getFhirConnection(FHIRInstance.HAPI_FHIR_PROD), max_workers=8).start()
+    service.serve(port=8088)
+    threading.Event().wait()
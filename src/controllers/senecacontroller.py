@@ -1,83 +1,278 @@
 import pandas as pd
 from requests.auth import HTTPBasicAuth
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from models.controller_utilities import *
 from models.getKPHCFHIR import *
 from models.seneca import *
 import models.parse_fhir as parse_fhir
+from models.bulk_fhir import BulkData
+from models.batch_fhir import getPatientBatch, batchSupported
+from models.columnar_output import ColumnarWriter
+from models.parse_pool import ParseStage
+from models.reference_tables import loadReferenceTable
 from controllers.fhir_connection import *
 from controllers.getCohortHAPI import *
+from controllers.metrics import metrics, pipeline_errors
 
-def senecaControl(df:pd.DataFrame, fhirconn:FhirConnection):
+# epic patient id lookup goes through fhirconn.setUrn, which is shared state, so it is serialized
+_epic_id_lock = threading.Lock()
+
+def getEncounterWindow(row):
+    """admit datetime and the start/end date strings (YYYY-MM-DD) used to filter a cohort row's searches"""
+    # make sure all inputs are UTC
+    admit_datetime=datetime.datetime.strptime(row["admit_datetime"], '%Y-%m-%d %H:%M:%S %z')
+    # turn datetime into date string like 2019-09-08
+    start_date_txt= admit_datetime.strftime("%Y-%m-%d")
+    try: #use dis_datetime if it exists, otherwise use current datetime
+        dis_datetime = datetime.datetime.strptime(row["dis_datetime"], '%Y-%m-%d %H:%M:%S %z')
+        end_date_txt=dis_datetime.strftime("%Y-%m-%d")
+    except:
+        end_date_txt= datetime.datetime.now().strftime("%Y-%m-%d")
+    return admit_datetime, start_date_txt, end_date_txt
+
+def getFhirId(row, fhirconn:FhirConnection, bulk:BulkData=None):
+    """fhir patient id for a cohort row"""
+    fhir_id=None
+    # get pat id -- not a FHIR service for epic, so we need a conditional
+    # can try to put this somewhere else if thats better
+    if bulk is not None:
+        fhir_id=row["patid"]
+    elif isinstance(row.get("fhir_id"), str):
+        # rows built from an Encounter (scoring_service) already carry the patient's fhir id
+        fhir_id=row["fhir_id"]
+    elif fhirconn.conn_type=='epic':
+        with _epic_id_lock:
+            fhirconn.setUrn(row["urn"])
+            fhir_id= getPatientID(mrn=row["MRN"], fhirconn=fhirconn)
+    elif fhirconn.conn_type=='hapi':
+        fhir_id= getID(resource="Patient",identifier=row["MRN"], fhirconn=fhirconn)
+    else:
+        pass
+    return fhir_id
+
+def reduceObservations(pages, source:str, strict:bool=True, parser:ParseStage=None):
+    """streams Observation pages through a LatestObservationReducer and returns the latest row per de
+    (all getSenecaData needs) instead of every parsed observation. with a parser the pages are parsed
+    in its process pool while the next pages are fetched"""
+    reducer = parse_fhir.LatestObservationReducer(getValuesets(), strict=strict)
+    if parser is not None:
+        n_pages = parser.reduceObservations(pages, source, reducer)
+    else:
+        n_pages = 0
+        for page in pages:
+            reducer.addPage(page, source)
+            n_pages = n_pages + 1
+    if n_pages == 0: # same failure as pd.concat of no pages
+        raise ValueError(f"No Observation pages returned for {source}")
+    return reducer.frames()[0 if source == 'vitals' else 1]
+
+def getPatientInputs(row, fhirconn:FhirConnection, executor:ThreadPoolExecutor=None, bulk:BulkData=None, strict:bool=True,
+                     parser:ParseStage=None):
+    """fetches and parses all inputs for one cohort row.
+    Returns:
+        df_pat, df_obs_vitals, df_obs_labs, df_meds, df_conds, start_date_txt
+    if an executor is given the Patient, vitals, labs, MedicationRequest and Condition fetches
+    (and their parsing) run on it at the same time instead of one after another.
+    if bulk is given the inputs come from the loaded bulk export (row["patid"] is the fhir id)
+    instead of per-patient searches. strict=False uses the fast FastResource parsers in parse_fhir.
+    if a parser is given the Patient, Observation and Condition pages are parsed in its process pool.
+    when the server takes batch Bundles (fhirconn.batch_queries) the five searches go out as one batch POST
+    """
+    admit_datetime, start_date_txt, end_date_txt = getEncounterWindow(row)
+    fhir_id = getFhirId(row, fhirconn, bulk)
+    # first pages of every search in one round trip; None falls back to the single searches
+    batch = getPatientBatch(fhir_id, fhirconn, start_date_txt, end_date_txt) if bulk is None and batchSupported(fhirconn) else None
+
+    def pat():
+        #patient data for birth sex and dob
+        if bulk is not None:
+            fhir_obj = bulk.getPatient(fhir_id)
+        elif batch is not None:
+            fhir_obj = batch['patient']
+        else:
+            fhir_obj = getPatient(patID=fhir_id, fhirconn=fhirconn)
+        if parser is not None:
+            return parser.parsePatient(fhir_obj, strict).result()
+        return parse_fhir.parsePatient(fhir_obj, strict=strict)
+    def vitals():
+        if bulk is not None:
+            fhir_obj=bulk.getObservation(fhir_id, 'vital-signs', start_date=start_date_txt, end_date=end_date_txt)
+        elif batch is not None:
+            fhir_obj=batch['vital-signs']
+        else:
+            fhir_obj=getObservation(patID=fhir_id, category='vital-signs',fhirconn=fhirconn, start_date=start_date_txt, end_date=end_date_txt, stream=True)
+        #fhir_obj yields one bundle per page; each page is reduced to the latest row per de as it arrives and then dropped
+        return reduceObservations(fhir_obj, 'vitals', strict, parser)
+    def labs():
+        if bulk is not None:
+            fhir_obj=bulk.getObservation(fhir_id, 'laboratory', start_date=start_date_txt, end_date=end_date_txt)
+        elif batch is not None:
+            fhir_obj=batch['laboratory']
+        else:
+            fhir_obj=getObservation(patID=fhir_id, category='laboratory',fhirconn=fhirconn, start_date=start_date_txt, end_date=end_date_txt, stream=True)
+        return reduceObservations(fhir_obj, 'labs', strict, parser)
+    def meds():
+        # #medicationrequest -- no date filtering until epic nov 2022
+        if bulk is not None:
+            fhir_obj=bulk.getMedicationRequest(fhir_id, start_date=start_date_txt, end_date=end_date_txt)
+        elif batch is not None: # its _include'd Medications are already in medication_cache
+            fhir_obj=batch['medication_request']
+        else:
+            fhir_obj=getMedicationRequest(patID=fhir_id, fhirconn=fhirconn, start_date=start_date_txt, end_date=end_date_txt, stream=True)
+        # bulk Medications come from the export's own index, not the bounded medication_cache
+        lookup = bulk.getMedications if bulk is not None else None
+        return pd.concat([parse_fhir.parseMedRequest(x, fhirconn=fhirconn,start_date=admit_datetime,vs=axb_vs,batch=True,strict=strict,lookup=lookup) for x in fhir_obj])
+    def conds():
+        if bulk is not None:
+            fhir_obj=bulk.getCondition(fhir_id)
+        elif batch is not None:
+            fhir_obj=batch['condition']
+        else:
+            fhir_obj=getCondition(patID=fhir_id, fhirconn=fhirconn, start_date=start_date_txt, end_date=end_date_txt, stream=True)
+        if parser is not None: # submit every page before waiting so parsing overlaps the remaining fetches
+            return pd.concat([f.result() for f in [parser.parseCondition(x, strict) for x in fhir_obj]])
+        return pd.concat([parse_fhir.parseCondition(x, strict=strict) for x in fhir_obj])
+
+    if executor is None:
+        df_pat, df_obs_vitals, df_obs_labs, df_meds, df_conds = pat(), vitals(), labs(), meds(), conds()
+    else:
+        futures = [executor.submit(f) for f in (pat, vitals, labs, meds, conds)]
+        df_pat, df_obs_vitals, df_obs_labs, df_meds, df_conds = [f.result() for f in futures]
+
+    return df_pat, df_obs_vitals, df_obs_labs, df_meds, df_conds, start_date_txt
+
+def getPatientSenecaData(row, fhirconn:FhirConnection, executor:ThreadPoolExecutor=None, bulk:BulkData=None, strict:bool=True,
+                         writer:ColumnarWriter=None, parser:ParseStage=None):
+    """fetches and parses all inputs for one cohort row and returns the getSenecaData row.
+    writer (with intermediate=True) also gets the parsed inputs"""
+    df_pat, df_obs_vitals, df_obs_labs, df_meds, df_conds, start_date_txt = getPatientInputs(row, fhirconn, executor, bulk, strict, parser)
+    if writer is not None:
+        writer.writePatientInputs(df_pat['id'].iloc[0], start_date_txt, df_obs_vitals, df_obs_labs, df_meds, df_conds)
+    #prep data for seneca
+    df_seneca = getSenecaData(dfPat=df_pat,dfLabs=df_obs_labs, dfVitals=df_obs_vitals, dfConds=df_conds,
+                              dfSenecaList=getSenecaLoincs(),enctr_date=start_date_txt)
+    return df_seneca
+
+def getPatientCohortInputs(row_id, row, fhirconn:FhirConnection, executor:ThreadPoolExecutor=None, bulk:BulkData=None, strict:bool=True,
+                           writer:ColumnarWriter=None, parser:ParseStage=None):
+    """fetches one cohort row's inputs for getSenecaDataCohort. the frames are tagged with row_id
+    and trimmed to the columns the cohort builder reads so the whole cohort stays small in memory
+    """
+    df_pat, df_obs_vitals, df_obs_labs, df_meds, df_conds, start_date_txt = getPatientInputs(row, fhirconn, executor, bulk, strict, parser)
+    if writer is not None:
+        writer.writePatientInputs(df_pat['id'].iloc[0], start_date_txt, df_obs_vitals, df_obs_labs, df_meds, df_conds)
+    obs_cols = ['de', 'DateTime', 'value', 'unit']
+    df_pat = df_pat[['id', 'sex', 'dob']].iloc[[0]].assign(row_id=row_id, enctr_date=start_date_txt)
+    df_obs_vitals = df_obs_vitals.loc[df_obs_vitals['de'].notna(), obs_cols].assign(row_id=row_id)
+    df_obs_labs = df_obs_labs.loc[df_obs_labs['de'].notna(), obs_cols].assign(row_id=row_id)
+    df_conds = df_conds[['Codes']].assign(row_id=row_id)
+    return df_pat, df_obs_vitals, df_obs_labs, df_conds
+
+def senecaControl(df:pd.DataFrame, fhirconn:FhirConnection, max_workers:int=None, bulk:BulkData=None, strict:bool=True,
+                  cohort_features:bool=False, writer:ColumnarWriter=None, parser:ParseStage=None, metrics_path:str=None):
+    """runs the seneca pipeline for every row of a cohort dataframe
+    Args:
+        max_workers: number of patients in flight at once. None runs the patients one after
+            another; otherwise each patient's resource fetches also overlap. keep pool_maxsize in
+            fhirconfig at least max_workers*5 so the session pool is not the bottleneck
+        bulk: BulkData loaded from a $export (or ndjson files on disk). when given, patient inputs
+            are read from it instead of per-patient REST searches and df needs a patid column
+        strict: False parses the raw json without fhir.resources validation (same dataframes, less cpu)
+        cohort_features: True keeps each patient's trimmed long format inputs and builds the whole
+            seneca input matrix at the end with getSenecaDataCohort instead of getSenecaData per patient
+        writer: ColumnarWriter that the scores (and with intermediate=True each patient's parsed inputs)
+            are appended to. patients are then scored every writer.batch_rows rows as they complete
+            and the scores are not kept in memory
+        parser: ParseStage whose process pool parses the Patient, Observation and Condition pages while
+            the fetch threads keep fetching (MedicationRequests are still parsed on the fetch threads)
+        metrics_path: writes the run's request, page, parse and score metrics (controllers.metrics) to
+            this json file at the end
+    Returns:
+        list of one row seneca score dataframes, in cohort order (empty when writer is given)
+    """
     start=datetime.datetime.now()
     if __name__ == "__main__":
         logging.basicConfig()
         logging.getLogger().setLevel(logging.INFO)
 
-        df_seneca_score_all=[] # list of individual seneca dataframes
-        for index, row in df.iterrows():
+    df_seneca_data_all=[] # list of individual seneca input rows, scored together at the end
+    df_seneca_score_all=[] # list of individual seneca dataframes
+    def collect(df_seneca_data):
+        df_seneca_data_all.append(df_seneca_data)
+        # with a writer, score and write each full batch instead of holding every row to the end
+        if writer is not None and not cohort_features and len(df_seneca_data_all)>=writer.batch_rows:
+            writer.write('scores', senecaScoreBatch(pd.concat(df_seneca_data_all)))
+            df_seneca_data_all.clear()
+    # (task, args) per cohort row; args leave out executor, bulk and strict
+    if cohort_features:
+        # positional row ids: the cohort index need not be unique (eg concatenated search pages)
+        tasks=[(getPatientCohortInputs, (row_id, row)) for row_id, (index, row) in enumerate(df.iterrows())]
+    else:
+        tasks=[(getPatientSenecaData, (row,)) for index, row in df.iterrows()]
+    if max_workers is None:
+        for task, args in tasks:
             try:
-                # make sure all inputs are UTC
-                admit_datetime=datetime.datetime.strptime(row["admit_datetime"], '%Y-%m-%d %H:%M:%S %z')
-                # turn datetime into date string like 2019-09-08
-                start_date_txt= admit_datetime.strftime("%Y-%m-%d")
-                try: #use dis_datetime if it exists, otherwise use current datetime
-                    dis_datetime = datetime.datetime.strptime(row["dis_datetime"], '%Y-%m-%d %H:%M:%S %z')
-                    end_date_txt=dis_datetime.strftime("%Y-%m-%d")
-                except:
-                    end_date_txt= datetime.datetime.now().strftime("%Y-%m-%d")
-                # get pat id -- not a FHIR service for epic, so we need a conditional
-                # can try to put this somewhere else if thats better
-                if fhirconn.conn_type=='epic':
-                    fhirconn.setUrn(row["urn"])
-                    fhir_id= getPatientID(mrn=row["MRN"], fhirconn=fhirconn)
-                elif fhirconn.conn_type=='hapi':
-                    fhir_id= getID(resource="Patient",identifier=row["MRN"], fhirconn=fhirconn)
-                else:
-                    pass
-                #patient data for birth sex and dob
-                fhir_obj = getPatient(patID=fhir_id, fhirconn=fhirconn)
-                df_pat=parse_fhir.parsePatient(fhir_obj)
-                #vitals data
-                fhir_obj=getObservation(patID=fhir_id, category='vital-signs',fhirconn=fhirconn, start_date=start_date_txt, end_date=end_date_txt)
-                #parseObs into dataframe
-                #fhir_obj is a list with multiple elements if there are multiple pages in the response
-                df_obs_vitals = pd.concat([parse_fhir.parseObservation(x, df_valuesets) for x in fhir_obj])
-                # lab data
-                fhir_obj=getObservation(patID=fhir_id, category='laboratory',fhirconn=fhirconn, start_date=start_date_txt, end_date=end_date_txt)
-                #parseObs into dataframe
-                df_obs_labs = pd.concat([parse_fhir.parseObservation(x, df_valuesets) for x in fhir_obj])
-                # #medicationrequest -- no date filtering until epic nov 2022
-                fhir_obj=getMedicationRequest(patID=fhir_id, fhirconn=fhirconn, start_date=start_date_txt, end_date=end_date_txt)
-                #parse meds into dataframe
-                df_meds = pd.concat([parse_fhir.parseMedRequest(x, fhirconn=fhirconn,start_date=admit_datetime,vs=axb_vs) for x in fhir_obj])
-                # conditions
-                fhir_obj=getCondition(patID=fhir_id, fhirconn=fhirconn, start_date=start_date_txt, end_date=end_date_txt)
-                df_conds = pd.concat([parse_fhir.parseCondition(x) for x in fhir_obj])
-
-                #prep data for seneca
-                df_seneca = getSenecaData(dfPat=df_pat,dfLabs=df_obs_labs, dfVitals=df_obs_vitals, dfConds=df_conds,
-                                          dfSenecaList=seneca_loincs,enctr_date=start_date_txt)
-                #calculate seneca
-                df_seneca_score=senecaScore(df_seneca)
-                print(df_seneca_score)
-                df_seneca_score_all.append(df_seneca_score)
+                collect(task(*args, fhirconn, bulk=bulk, strict=strict, writer=writer, parser=parser))
             except Exception as e:
+                pipeline_errors.inc(stage='patient')
                 logging.exception(f"Error: {e}")
+    else:
+        # separate pool for the per-resource fetches so patient tasks never wait on their own pool
+        with ThreadPoolExecutor(max_workers=max_workers) as patient_pool, \
+                ThreadPoolExecutor(max_workers=max_workers*5) as resource_pool:
+            futures = [patient_pool.submit(task, *args, fhirconn, resource_pool, bulk, strict, writer, parser) for task, args in tasks]
+            # collect in submit order so results match the sequential path
+            for future in futures:
+                try:
+                    collect(future.result())
+                except Exception as e:
+                    pipeline_errors.inc(stage='patient')
+                    logging.exception(f"Error: {e}")
+    if cohort_features and len(df_seneca_data_all)>0:
+        # build the whole seneca input matrix from the long format inputs in one pass
+        df_pats, df_vitals, df_labs, df_conds = [pd.concat(frames) for frames in zip(*df_seneca_data_all)]
+        df_seneca_data_all=[getSenecaDataCohort(df_pats, df_vitals, df_labs, df_conds, getSenecaLoincs(), by=['row_id'])]
+    #calculate seneca for the whole cohort in one pass
+    if len(df_seneca_data_all)>0:
+        df_seneca_scores=senecaScoreBatch(pd.concat(df_seneca_data_all))
+        print(df_seneca_scores)
+        if writer is not None:
+            writer.write('scores', df_seneca_scores)
+        else:
+            df_seneca_score_all=[df_seneca_scores.iloc[[i]] for i in range(len(df_seneca_scores.index))]
+    if writer is not None:
+        writer.flush()
     end=datetime.datetime.now()
     start_time = start.strftime("%H:%M:%S")
     end_time = end.strftime("%H:%M:%S")
     print('start time: ', start_time)
     print('end time: ', end_time)
     print('process time:', end-start)
+    if metrics_path is not None:
+        metrics.writeJson(metrics_path)
     print("seneca complete")
     return df_seneca_score_all
 
-# read in list of value set codes
-df_valuesets = pd.read_csv('\\path_to_file\\DE_valuesets_with_names.csv',
-                    encoding='unicode_escape')
-seneca_loincs=pd.read_csv('\\path_to_file\\seneca_loincs.csv',
-                    encoding='unicode_escape')
+# list of value set codes and the seneca variables; read on first use from their compiled artifacts
+# (models.reference_tables), which are rebuilt when a csv changes
+valuesets_csv = '\\path_to_file\\DE_valuesets_with_names.csv'
+seneca_loincs_csv = '\\path_to_file\\seneca_loincs.csv'
+
+def getValuesets():
+    return loadReferenceTable(valuesets_csv, encoding='unicode_escape')
+
+def getSenecaLoincs():
+    return loadReferenceTable(seneca_loincs_csv, encoding='unicode_escape')
+
+def __getattr__(name):
+    # df_valuesets and seneca_loincs stay importable from this module but are only loaded when asked for
+    if name == 'df_valuesets':
+        return getValuesets()
+    if name == 'seneca_loincs':
+        return getSenecaLoincs()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 #rxnorm value set for antibtiocs 
 axb_vs=['722','19711','733','151392','18631','151399','203729','203635','2176','20481','25033','19552','2193','215926','2194','224901','2231','2239','2348',
@@ -85,9 +280,10 @@ axb_vs=['722','19711','733','151392','18631','151399','203729','203635','2176','
         '70618','9449','202807','10180','196499','10395','10831','220466','11124','196474','74170','539819']
 
 if __name__ == "__main__":
-    df = getHapiCohort(FhirConnection(FHIRInstance.UPMC_FHIR_PROD),n=1000)
-    df_seneca_result = pd.concat(senecaControl(df, FhirConnection(FHIRInstance.UPMC_FHIR_PROD)))
-    file_suffix = FhirConnection(FHIRInstance.UPMC_FHIR_PROD).FHIRInst.value + ".csv"
-    #get mrn to add back to data
-    df_mrn=pd.merge(df_seneca_result,df, left_on='id', right_on='patid')
-    df_mrn.to_csv('df_seneca_result_'+file_suffix)
+    conn = getFhirConnection(FHIRInstance.UPMC_FHIR_PROD)
+    df = getHapiCohort(conn,n=1000)
+    # scores are appended to parquet as patients complete instead of being concatenated and written as csv
+    with ColumnarWriter('seneca_result_' + conn.FHIRInst.value) as writer:
+        senecaControl(df, conn, writer=writer)
+    #mrn of each patient, to add back to the scores (id) on patid
+    df[['patid', 'MRN']].to_parquet(writer.out_dir + '/cohort-' + writer.run_id + '.parquet', index=False)
@@ -0,0 +1,152 @@
+import logging
+import threading
+import urllib.parse
+from models.getKPHCFHIR import *
+from controllers.metrics import metrics
+
+batch_requests = metrics.counter('fhir_batch_requests_total', 'batch Bundle POSTs and their entries, by outcome', ('outcome',))
+
+# url_root_fhir -> False once a server has rejected a batch Bundle, so it is only asked once per run
+_batch_support = {}
+_batch_support_lock = threading.Lock()
+
+
+def batchSupported(fhirconn:FhirConnection):
+    """True if fhirconn has batch_queries on and its server has not rejected a batch Bundle"""
+    if not getattr(fhirconn, 'batch_queries', False):
+        return False
+    with _batch_support_lock:
+        return _batch_support.get(fhirconn.url_root_fhir, True)
+
+
+def _setBatchSupported(fhirconn:FhirConnection, supported:bool):
+    with _batch_support_lock:
+        _batch_support[fhirconn.url_root_fhir] = supported
+
+
+def patientQueries(patID:str, start_date:str, end_date:str, fhirconn:FhirConnection=None):
+    """(key, relative url) of the searches getPatientInputs makes for one patient. the urls match the
+    getKPHCFHIR search functions (with fhirconn's searchParams when it is given); the MedicationRequest search also _include's the referenced Medications
+    so parseMedRequest finds them in medication_cache. _revinclude from Patient is not used because the
+    included Observations could not be filtered by category or date
+    """
+    dates = ''
+    if start_date is not None:
+        dates = dates + '&date=ge' + start_date
+    if end_date is not None:
+        dates = dates + '&date=le' + end_date
+    params = (lambda resourcetype: searchParams(resourcetype, fhirconn)) if fhirconn is not None else (lambda resourcetype: '')
+    return [('patient', 'Patient/' + patID),
+            ('vital-signs', 'Observation?patient=' + patID + '&category=vital-signs' + dates + params('Observation')),
+            ('laboratory', 'Observation?patient=' + patID + '&category=laboratory' + dates + params('Observation')),
+            ('medication_request', 'MedicationRequest?patient=' + patID + '&category=Inpatient' + dates
+             + '&_include=MedicationRequest:medication' + params('MedicationRequest')),
+            ('condition', 'Condition?patient=' + patID + params('Condition'))]
+
+
+def toBatchBundle(queries:list):
+    """batch Bundle with one GET entry per (key, relative url)"""
+    return {'resourceType': 'Bundle', 'type': 'batch',
+            'entry': [{'request': {'method': 'GET', 'url': url}} for key, url in queries]}
+
+
+def postBatch(bundle:dict, fhirconn:FhirConnection):
+    """POSTs a batch Bundle to the server base url.
+    Returns:
+        the batch-response entries in request order, or None if the request failed or the server does
+        not take batches (which is remembered for the server)
+    """
+    try:
+        r = fhirconn.post(fhirconn.url_base_fhir, resource='batch', json=bundle,
+                          headers={'Content-Type': 'application/fhir+json'})
+    except Exception as e:
+        logging.exception(f"Batch request failed: {e}")
+        batch_requests.inc(outcome='error')
+        return None
+    # the body is decoded on its own so a rejection with an html error page (or an OperationOutcome
+    # with another content type) still gets the status check below
+    try:
+        response = r.json() if r.content else {}
+    except ValueError:
+        response = {}
+    if not isinstance(response, dict):
+        response = {}
+    entries = response.get('entry') or []
+    if r.status_code >= 400 or response.get('type') != 'batch-response' or len(entries) != len(bundle['entry']):
+        if r.status_code < 500 or r.status_code == 501:
+            # the server does not do batch (or answers it wrongly); use single searches from now on
+            logging.warning(f"{fhirconn.url_root_fhir} does not accept batch Bundles ({r.status_code}), using single requests")
+            _setBatchSupported(fhirconn, False)
+            batch_requests.inc(outcome='unsupported')
+        else:
+            batch_requests.inc(outcome='error')
+        return None
+    batch_requests.inc(outcome='batch')
+    return entries
+
+
+def _entryOk(entry:dict):
+    return str((entry.get('response') or {}).get('status', '')).startswith('2') and entry.get('resource') is not None
+
+
+def splitIncludes(pages, fhirconn:FhirConnection, cache:LruTtlCache=medication_cache):
+    """yields each MedicationRequest page without its _include'd Medications, which go into the cache"""
+    for page in pages:
+        entries = page.get('entry')
+        if entries:
+            matches = []
+            for entry in entries:
+                resource = entry.get('resource') or {}
+                if (entry.get('search') or {}).get('mode') == 'include' or resource.get('resourceType') == 'Medication':
+                    # a Medication cut down by _elements without its code is left for parseMedRequest to fetch
+                    if cache is not None and resource.get('resourceType') == 'Medication' and 'code' in resource:
+                        cache.put((fhirconn.url_root_fhir, resource.get('id')), resource)
+                else:
+                    matches.append(entry)
+            if len(matches) != len(entries):
+                page = dict(page)
+                if matches:
+                    page['entry'] = matches
+                else: # same as a searchset with no results
+                    del page['entry']
+        yield page
+
+
+def getPatientBatch(patID:str, fhirconn:FhirConnection, start_date:str, end_date:str):
+    """fetches the Patient and the first page of every search getPatientInputs needs in one batch Bundle
+    POST instead of five round trips. later pages are still fetched by following each searchset's next
+    link, and an entry that failed inside the batch is requested again on its own.
+    Returns:
+        None if the server does not take batches (callers then use the single search functions), else a dict
+        with 'patient' (the Patient resource) and 'vital-signs', 'laboratory', 'medication_request' and
+        'condition' page generators like the stream=True search functions return
+    Example:
+        batch=getPatientBatch(fhir_id, conn, '2021-03-01', '2021-03-04')
+        df=pd.concat([parse_fhir.parseCondition(x) for x in batch['condition']])
+    """
+    queries = patientQueries(patID, start_date, end_date, fhirconn)
+    entries = postBatch(toBatchBundle(queries), fhirconn)
+    if entries is None:
+        return None
+    single = {'patient': lambda: getPatient(patID=patID, fhirconn=fhirconn),
+              'vital-signs': lambda: getObservation(patID=patID, category='vital-signs', fhirconn=fhirconn,
+                                                    start_date=start_date, end_date=end_date, stream=True),
+              'laboratory': lambda: getObservation(patID=patID, category='laboratory', fhirconn=fhirconn,
+                                                   start_date=start_date, end_date=end_date, stream=True),
+              'medication_request': lambda: getMedicationRequest(patID=patID, fhirconn=fhirconn, start_date=start_date,
+                                                                 end_date=end_date, stream=True),
+              'condition': lambda: getCondition(patID=patID, fhirconn=fhirconn, start_date=start_date,
+                                                end_date=end_date, stream=True)}
+    batch = {}
+    for (key, url), entry in zip(queries, entries):
+        if not _entryOk(entry):
+            logging.warning(f"Batch entry {url} failed ({(entry.get('response') or {}).get('status')}), requesting it on its own")
+            batch_requests.inc(outcome='entry_fallback')
+            batch[key] = single[key]()
+        elif key == 'patient':
+            batch[key] = entry['resource']
+        else:
+            # next links are rebuilt against the search url like a search made on its own
+            pages = iterPages(urllib.parse.urljoin(fhirconn.url_base_fhir + '/', url), fhirconn, first_page=entry['resource'])
+            batch[key] = splitIncludes(pages, fhirconn) if key == 'medication_request' else pages
+    return batch
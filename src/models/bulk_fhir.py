@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from models.getKPHCFHIR import *
+
+# resource types the seneca pipeline needs from a bulk export
+bulk_resource_types = ['Patient', 'Observation', 'MedicationRequest', 'Condition', 'Medication']
+
+
+def kickoffExport(fhirconn:FhirConnection, resource_types:list=bulk_resource_types, group_id:str=None, since:str=None):
+    """starts a FHIR Bulk Data $export and returns the status url to poll
+    Args:
+        group_id: export only the members of this Group; None exports at the system level
+        since: only resources updated after this instant (FHIR _since)
+    Example:
+        status_url=kickoffExport(conn, group_id='ed-cohort')
+    """
+    if group_id is not None:
+        geturl = fhirconn.url_base_fhir + '/Group/' + group_id + '/$export'
+    else:
+        geturl = fhirconn.url_base_fhir + '/$export'
+    geturl = geturl + '?_type=' + ','.join(resource_types)
+    if since is not None:
+        geturl = geturl + '&_since=' + since
+    r = fhirconn.get(geturl, headers={'Accept': 'application/fhir+json', 'Prefer': 'respond-async'})
+    if r.status_code != 202:
+        raise Exception(f"Bulk export kick-off failed: {r.status_code} {r.text}")
+    return r.headers['Content-Location']
+
+
+def pollExport(fhirconn:FhirConnection, status_url:str, interval:float=10, max_wait:float=6*60*60):
+    """polls a bulk export status url until it completes and returns the manifest output list
+    (dicts with type and url). honors Retry-After while the server answers 202
+    """
+    waited = 0
+    while True:
+        r = fhirconn.get(status_url, headers={'Accept': 'application/json'})
+        if r.status_code == 200:
+            return r.json().get('output', [])
+        if r.status_code != 202:
+            raise Exception(f"Bulk export failed: {r.status_code} {r.text}")
+        try:
+            wait = float(r.headers.get('Retry-After', interval))
+        except ValueError:
+            wait = interval
+        logging.info(f"Bulk export in progress: {r.headers.get('X-Progress')}")
+        if waited + wait > max_wait:
+            raise Exception(f"Bulk export did not finish within {max_wait} seconds")
+        time.sleep(wait)
+        waited = waited + wait
+
+
+def downloadExport(fhirconn:FhirConnection, output:list, dest_dir:str):
+    """streams every file in a bulk export manifest to dest_dir as <type>_<n>.ndjson
+    Returns:
+        list of downloaded file paths
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    paths = []
+    for n, item in enumerate(output):
+        path = os.path.join(dest_dir, f"{item['type']}_{n}.ndjson")
+        with fhirconn.get(item['url'], headers={'Accept': 'application/fhir+ndjson'}, stream=True) as r:
+            r.raise_for_status()
+            with open(path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=1024*1024):
+                    f.write(chunk)
+        paths.append(path)
+    return paths
+
+
+def iterNdjson(path:str):
+    """generator over the resources of one ndjson file, one line at a time"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _refId(reference:dict):
+    # "Patient/123" -> "123"
+    try:
+        return reference.get('reference').split('/')[-1]
+    except Exception:
+        return None
+
+
+def _resourceDate(resource:dict):
+    # yyyy-mm-dd of the date the REST search filters on
+    if resource.get('resourceType') == 'MedicationRequest':
+        value = resource.get('authoredOn')
+    else:
+        value = resource.get('effectiveDateTime') or resource.get('issued')
+        if value is None and resource.get('effectivePeriod') is not None:
+            value = resource['effectivePeriod'].get('start')
+    return value[:10] if value else None
+
+
+def toBundle(resources:list):
+    # searchset bundle in the shape the parse_fhir functions expect
+    bundle = {'resourceType': 'Bundle', 'type': 'searchset', 'total': len(resources)}
+    if resources: # empty searchsets have no entry, same as a server response
+        bundle['entry'] = [{'resource': x} for x in resources]
+    return bundle
+
+
+class BulkData():
+    """ per-patient view of a bulk export that streams the ndjson files from disk. loading reads each file
+        one line at a time and keeps only an index of where every patient's resources are (file and byte
+        offset), so a system level export is never held in memory; the resources are read back from disk
+        when a patient is asked for. the methods return the same structures as the REST fetch functions
+        in getKPHCFHIR (a Patient dict and lists of bundle pages), so they drop into getPatientSenecaData
+    Example:
+        bulk=BulkData.fromDirectory('export/', patient_ids=set(df.patid))
+    """
+
+    def __init__(self, patient_ids:set=None):
+        self.patient_ids = patient_ids
+        self.paths = [] # index n of the (n, offset) locations below
+        self.patients = {}
+        self.observations = defaultdict(lambda: defaultdict(list))
+        self.medication_requests = defaultdict(lambda: defaultdict(list))
+        self.conditions = defaultdict(list)
+        self.medications = {}
+
+    @classmethod
+    def fromDirectory(cls, ndjson_dir:str, patient_ids:set=None):
+        bulk = cls(patient_ids)
+        for name in sorted(os.listdir(ndjson_dir)):
+            if name.endswith('.ndjson'):
+                bulk.load(os.path.join(ndjson_dir, name))
+        return bulk
+
+    @classmethod
+    def fromExport(cls, fhirconn:FhirConnection, dest_dir:str, patient_ids:set=None, group_id:str=None, since:str=None):
+        """runs kick-off, poll and download and then loads the files"""
+        status_url = kickoffExport(fhirconn, group_id=group_id, since=since)
+        downloadExport(fhirconn, pollExport(fhirconn, status_url), dest_dir)
+        return cls.fromDirectory(dest_dir, patient_ids)
+
+    def load(self, path:str):
+        """indexes every resource of one ndjson file. resources for patients outside patient_ids are skipped.
+        the file must stay in place, resources are read from it on demand"""
+        n = len(self.paths)
+        self.paths.append(path)
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    self.add(json.loads(line), (n, offset))
+                offset = offset + len(line)
+
+    def add(self, resource:dict, location:tuple):
+        """indexes one resource at location, a (file number, byte offset) pair of its ndjson line"""
+        rtype = resource.get('resourceType')
+        if rtype == 'Medication':
+            self.medications[resource.get('id')] = location
+            return
+        if rtype == 'Patient':
+            patid = resource.get('id')
+        else:
+            patid = _refId(resource.get('subject') or resource.get('patient') or {})
+        if patid is None or (self.patient_ids is not None and patid not in self.patient_ids):
+            return
+        if rtype == 'Patient':
+            self.patients[patid] = location
+        elif rtype == 'Observation':
+            codes = {coding.get('code') for category in resource.get('category') or []
+                     for coding in category.get('coding') or []}
+            for code in codes:
+                self.observations[patid][code].append(location)
+        elif rtype == 'MedicationRequest':
+            # by category code or text, lower case, for the category=Inpatient the REST search asks for
+            codes = {x.lower() for category in resource.get('category') or []
+                     for x in [category.get('text')] + [coding.get('code') for coding in category.get('coding') or []] if x}
+            for code in codes:
+                self.medication_requests[patid][code].append(location)
+        elif rtype == 'Condition':
+            self.conditions[patid].append(location)
+
+    def read(self, locations:list):
+        """the resources at a list of (file number, byte offset) locations, in order"""
+        resources = []
+        files = {}
+        try:
+            for n, offset in locations:
+                if n not in files:
+                    files[n] = open(self.paths[n], 'rb')
+                files[n].seek(offset)
+                resources.append(json.loads(files[n].readline()))
+        finally:
+            for f in files.values():
+                f.close()
+        return resources
+
+    def getMedications(self, medIDs:list):
+        """dict of medication id -> exported Medication for the ids in the export, read from disk.
+        pass it as parseMedRequest's lookup so bulk runs resolve Medications without the server"""
+        medIDs = [x for x in dict.fromkeys(medIDs) if x in self.medications]
+        return dict(zip(medIDs, self.read([self.medications[x] for x in medIDs])))
+
+    def _inWindow(self, resources:list, start_date:str, end_date:str):
+        result = []
+        for resource in resources:
+            date = _resourceDate(resource)
+            if start_date is not None and (date is None or date < start_date):
+                continue
+            if end_date is not None and (date is None or date > end_date):
+                continue
+            result.append(resource)
+        return result
+
+    def getPatient(self, patID:str):
+        location = self.patients.get(patID)
+        return self.read([location])[0] if location is not None else None
+
+    def getObservation(self, patID:str, category:str, start_date:str, end_date:str):
+        return [toBundle(self._inWindow(self.read(self.observations.get(patID, {}).get(category, [])), start_date, end_date))]
+
+    def getMedicationRequest(self, patID:str, start_date:str, end_date:str, category:str='Inpatient'):
+        # category=Inpatient like getMedicationRequest and the batch query
+        return [toBundle(self._inWindow(self.read(self.medication_requests.get(patID, {}).get(category.lower(), [])), start_date, end_date))]
+
+    def getCondition(self, patID:str):
+        # condition api does not take dates
+        return [toBundle(self.read(self.conditions.get(patID, [])))]
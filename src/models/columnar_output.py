@@ -0,0 +1,163 @@
+import datetime
+import os
+import threading
+import uuid
+import numpy as np
+import pandas as pd
+from models.seneca import seneca_features
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError: # optional; only needed to write columnar output
+    pa = None
+
+# arrow types of the tables ColumnarWriter knows about. columns missing from a frame are written as
+# nulls and extra columns are dropped, so every part file of a table has the same schema
+def _schemas():
+    string_list = pa.list_(pa.string())
+    utc = pa.timestamp('us', tz='UTC')
+    return {
+        'scores': pa.schema([('id', pa.string())] +
+                            [(name, pa.float64()) for name in seneca_features] +
+                            [('dist.alpha', pa.float64()), ('dist.beta', pa.float64()), ('dist.gamma', pa.float64()),
+                             ('dist.delta', pa.float64()), ('min_val', pa.float64()), ('phenotype', pa.string())]),
+        # value is split into the numeric result and the text of non numeric results (valueString etc)
+        'observations': pa.schema([('patid', pa.string()), ('enctr_date', pa.date32()), ('source', pa.string()),
+                                   ('id', pa.string()), ('DateTime', pa.timestamp('us')), ('value', pa.float64()),
+                                   ('value_text', pa.string()), ('unit', pa.string()), ('loinc_list', string_list),
+                                   ('system', pa.string()), ('code', pa.string()), ('display', pa.string()),
+                                   ('text', pa.string()), ('de', pa.int32()), ('de_name', pa.string()),
+                                   ('culture_indicator', pa.int8())]),
+        'medications': pa.schema([('patid', pa.string()), ('enctr_date', pa.date32()), ('id', pa.string()),
+                                  ('encid', pa.string()), ('ordered_date', utc), ('medreq_display', pa.string()),
+                                  ('med_text', pa.string()), ('format', pa.string()), ('rxnorm', string_list),
+                                  ('therapyType', pa.string()), ('abx_ind', pa.int8()), ('enc_date', utc),
+                                  ('time_diff_hours', pa.float64())]),
+        'conditions': pa.schema([('patid', pa.string()), ('enctr_date', pa.date32()), ('id', pa.string()),
+                                 ('StartDate', pa.date32()), ('EndDate', pa.date32()), ('ListType', pa.string()),
+                                 ('Codes', string_list), ('Description', pa.string())]),
+    }
+
+
+def _isMissing(x):
+    return x is None or (isinstance(x, float) and np.isnan(x)) or x is pd.NaT
+
+
+def _column(values:pd.Series, field):
+    # one pandas column -> arrow array of the field's type
+    t = field.type
+    if pa.types.is_list(t):
+        return pa.array([None if not isinstance(x, (list, tuple, np.ndarray)) else [None if _isMissing(y) else str(y) for y in x]
+                         for x in values], type=t)
+    if pa.types.is_string(t):
+        return pa.array([None if _isMissing(x) else str(x) for x in values], type=t)
+    if pa.types.is_timestamp(t):
+        values = pd.to_datetime(values, errors='coerce', utc=t.tz is not None)
+        if t.tz is not None:
+            values = values.dt.tz_convert('UTC')
+        return pa.array(values, type=t, from_pandas=True)
+    if pa.types.is_date(t):
+        return pa.array(pd.to_datetime(values, errors='coerce').dt.date, type=t, from_pandas=True)
+    # numbers: anything that is not a number becomes null
+    values = pd.to_numeric(values, errors='coerce')
+    if pa.types.is_integer(t):
+        return pa.array(values.astype('Int64'), type=t, from_pandas=True)
+    return pa.array(values.astype(float), type=t, from_pandas=True)
+
+
+def toArrowTable(df:pd.DataFrame, schema):
+    """converts a pipeline dataframe to an arrow table with the given schema (typed columns, python
+    lists as list<string>, missing columns as nulls)"""
+    df = df.reset_index(drop=True)
+    if 'value' in schema.names and 'value_text' in schema.names and 'value_text' not in df.columns:
+        # observations: keep the text of results that are not numbers
+        numeric = pd.to_numeric(df['value'], errors='coerce')
+        df = df.assign(value=numeric, value_text=df['value'].where(numeric.isna() & df['value'].notna()))
+    arrays = [_column(df[field.name], field) if field.name in df.columns else pa.nulls(len(df), type=field.type)
+              for field in schema]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+class ColumnarWriter():
+    """ appends pipeline output to partitioned parquet (or arrow ipc) files as it is produced.
+        rows are buffered per table and written as one part file every batch_rows rows, under
+        out_dir/<table>/run_date=<yyyy-mm-dd>/part-<run id>-<n>.parquet, so a run never holds all
+        of its results in memory and pd.read_parquet(out_dir + '/scores') reads every run back.
+        intermediate=True also writes each patient's parsed observations, medications and conditions.
+        thread safe; call close() (or use it as a context manager) to write the last partial batch
+    Example:
+        with ColumnarWriter('seneca_out/', intermediate=True) as writer:
+            senecaControl(df, conn, writer=writer)
+    """
+
+    def __init__(self, out_dir:str, batch_rows:int=10000, intermediate:bool=False, format:str='parquet'):
+        if pa is None:
+            raise ImportError("ColumnarWriter needs pyarrow (pip install pyarrow)")
+        if format not in ('parquet', 'arrow'):
+            raise ValueError(f"Unknown output format: {format}")
+        self.out_dir = out_dir
+        self.batch_rows = batch_rows
+        self.intermediate = intermediate
+        self.format = format
+        self.schemas = _schemas()
+        self.run_id = datetime.datetime.now().strftime('%Y%m%dT%H%M%S') + '-' + uuid.uuid4().hex[:8]
+        self.run_date = datetime.date.today().isoformat()
+        self._buffers = {table: [] for table in self.schemas}
+        self._rows = {table: 0 for table in self.schemas}
+        self._parts = {table: 0 for table in self.schemas}
+        self._lock = threading.Lock()
+
+    def write(self, table:str, df:pd.DataFrame):
+        """buffers the rows of df for table and writes a part file once batch_rows are buffered"""
+        if df is None or len(df.index) == 0:
+            return
+        # convert now so the buffer holds compact arrow data instead of the pandas frame
+        data = toArrowTable(df, self.schemas[table])
+        with self._lock:
+            self._buffers[table].append(data)
+            self._rows[table] = self._rows[table] + data.num_rows
+            if self._rows[table] >= self.batch_rows:
+                self._flush(table)
+
+    def writePatientInputs(self, patid:str, enctr_date:str, df_obs_vitals:pd.DataFrame, df_obs_labs:pd.DataFrame,
+                           df_meds:pd.DataFrame, df_conds:pd.DataFrame):
+        """writes one patient's parsed inputs, tagged with the fhir patient id and encounter date"""
+        if not self.intermediate:
+            return
+        self.write('observations', pd.concat([df_obs_vitals.assign(source='vitals'), df_obs_labs.assign(source='labs')])
+                   .assign(patid=patid, enctr_date=enctr_date))
+        self.write('medications', df_meds.assign(patid=patid, enctr_date=enctr_date))
+        self.write('conditions', df_conds.assign(patid=patid, enctr_date=enctr_date))
+
+    def _flush(self, table:str):
+        if self._rows[table] == 0:
+            return
+        data = pa.concat_tables(self._buffers[table])
+        part_dir = os.path.join(self.out_dir, table, 'run_date=' + self.run_date)
+        os.makedirs(part_dir, exist_ok=True)
+        name = f'part-{self.run_id}-{self._parts[table]:05d}.{self.format}'
+        # write to a hidden file (skipped by dataset readers) and rename so readers never see a half written part
+        tmp_path = os.path.join(part_dir, '.' + name + '.tmp')
+        if self.format == 'parquet':
+            pq.write_table(data, tmp_path, compression='zstd')
+        else:
+            feather.write_feather(data, tmp_path, compression='zstd')
+        os.replace(tmp_path, os.path.join(part_dir, name))
+        self._buffers[table] = []
+        self._rows[table] = 0
+        self._parts[table] = self._parts[table] + 1
+
+    def flush(self):
+        with self._lock:
+            for table in self._buffers:
+                self._flush(table)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -1,9 +1,20 @@
 import requests
 import logging
 import pandas as pd
-from sqlalchemy import *
 from projectconfig.definitions import ROOT_DIR
 from controllers.fhir_connection import *
+from models.getKPHCFHIR import iterEntries
+from models.lru_cache import LruTtlCache
+
+# hapi patient id -> MRN, shared by getHapiMRN and getHapiMRNs
+mrn_cache = LruTtlCache(maxsize=100000)
+
+def _hapiMRN(resource:dict):
+    # KP uses kp1013 to signify mrn, upmc uses MRN
+    identifier = resource["identifier"][0]
+    if (identifier["type"]["text"]=="MYID" or identifier["type"]["text"]=="MRN"):
+        return identifier["value"]
+    return None
 
 
 #generic version of getPatientID that will work for any resource
@@ -13,7 +24,7 @@ def getID(resource:str, identifier:str, fhirconn:FhirConnection):
     # get response that includes patient id
     # parse response to get the id
     try:
-        r = requests.get(geturl, **fhirconn.reqkwargs)
+        r = fhirconn.get(geturl)
         response=r.json()
         #gets first ID if there are more than 1 
         try:
@@ -27,24 +38,24 @@ def getID(resource:str, identifier:str, fhirconn:FhirConnection):
         raise(Exception(f"Could not get resource: {e}"))
     return id
 
-def getHapiMRN(patid:str, fhirconn:FhirConnection):
+def getHapiMRN(patid:str, fhirconn:FhirConnection, cache:LruTtlCache=mrn_cache):
     """gets an MRN from Hapi FHIR patient resource given a Hapi FHIR Pat ID
     """
+    key = (fhirconn.url_root_fhir, patid)
+    mrn = cache.get(key) if cache is not None else None
+    if mrn is not None:
+        return mrn
 
     geturl = fhirconn.getUrl(resourcetype="Patient")+"/" + patid
 
     # get response that includes patient id
     # parse response to get the id
     try:
-        r = requests.get(geturl, **fhirconn.reqkwargs)
+        r = fhirconn.get(geturl)
         response=r.json()
         #gets first ID if there are more than 1
         try:
-            # KP uses kp1013 to signify mrn, upmc uses MRN
-            if (response["identifier"][0]["type"]["text"]=="MYID" or response["identifier"][0]["type"]["text"]=="MRN"):
-                id=response["identifier"][0]["value"]
-            else:
-                id=None
+            id=_hapiMRN(response)
         except KeyError:
             print(f"Cannot locate patient resource: patient:{patid}")
             raise Exception(f"Cannot locate patient resource: patient:{patid}")
@@ -52,4 +63,35 @@ def getHapiMRN(patid:str, fhirconn:FhirConnection):
     except Exception as e:
         logging.exception(f"Could not get resource: {e}")
         raise(Exception(f"Could not get resource: {e}"))
+    if cache is not None and id is not None:
+        cache.put(key, id)
     return id
+
+def getHapiMRNs(patids:list, fhirconn:FhirConnection, cache:LruTtlCache=mrn_cache, chunk_size:int=100):
+    """MRNs for many Hapi FHIR patient ids with Patient?_id=a,b,c&_elements=identifier searches of up to
+    chunk_size ids, skipping ids already in the cache
+    Returns:
+        dict of patient id -> MRN (None when the patient has no MRN identifier or was not returned)
+    """
+    mrns = {}
+    missing = []
+    for patid in dict.fromkeys(patids): # unique, keeps order
+        mrn = cache.get((fhirconn.url_root_fhir, patid)) if cache is not None else None
+        if mrn is not None:
+            mrns[patid] = mrn
+        else:
+            missing.append(patid)
+    for i in range(0, len(missing), chunk_size):
+        chunk = missing[i:i+chunk_size]
+        geturl = fhirconn.getUrl(resourcetype="Patient")+'?_id='+','.join(chunk)+'&_elements=identifier&_count='+str(len(chunk))
+        for resource in iterEntries(geturl, fhirconn):
+            if resource is None or resource.get('resourceType') != 'Patient':
+                continue
+            try:
+                mrn = _hapiMRN(resource)
+            except (KeyError, IndexError):
+                mrn = None
+            mrns[resource.get('id')] = mrn
+            if cache is not None and mrn is not None:
+                cache.put((fhirconn.url_root_fhir, resource.get('id')), mrn)
+    return {patid: mrns.get(patid) for patid in dict.fromkeys(patids)}
@@ -0,0 +1,249 @@
+import datetime
+import logging
+import os
+import pickle
+import threading
+import pandas as pd
+import models.parse_fhir as parse_fhir
+from models.bulk_fhir import toBundle
+from models.seneca import senecaDemographics, elixhauserScore, senecaScoreBatch
+
+# observation sources and the Observation category each one is searched with (getPatientInputs)
+observation_sources = {'vital-signs': 'vitals', 'laboratory': 'labs'}
+
+
+def observationSource(observation:dict):
+    """'vitals' or 'labs' for an Observation resource by its category, None for any other category"""
+    for category in observation.get('category') or []:
+        for coding in category.get('coding') or []:
+            if coding.get('code') in observation_sources:
+                return observation_sources[coding['code']]
+    return None
+
+
+def observationDate(observation:dict):
+    """the date (YYYY-MM-DD, utc) an Observation's date search matches: effective[x], or issued without one"""
+    period = observation.get('effectivePeriod') or {}
+    value = (observation.get('effectiveDateTime') or observation.get('effectiveInstant') or period.get('start')
+             or observation.get('issued'))
+    if not value:
+        return None
+    try:
+        instant = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return value[:10]
+    if instant.tzinfo is not None:
+        instant = instant.astimezone(datetime.timezone.utc)
+    return instant.strftime('%Y-%m-%d')
+
+
+def senecaValue(de, value, unit, source:str):
+    """the value and unit getSenecaData uses for one parsed observation: numeric (text is NaN), vitals in
+    DegF converted to DegC and crp labs (de 38) in mg/dL converted to mg/L"""
+    value = pd.to_numeric(value, errors='coerce')
+    if source == 'vitals' and unit == 'DegF':
+        return (value-32)*5/9, 'DegC'
+    if source == 'labs' and de == 38 and unit == 'mg/dL':
+        return value*10, 'mg/L'
+    return value, unit
+
+
+def _same(before, after):
+    # == on (value, unit) tuples and elix scores, but a NaN value (eg a text result) equals another NaN
+    if isinstance(before, tuple) and isinstance(after, tuple) and len(before) == len(after):
+        return all(_same(x, y) for x, y in zip(before, after))
+    if before == after:
+        return True
+    try:
+        return bool(pd.isna(before) and pd.isna(after))
+    except (TypeError, ValueError):
+        return False
+
+
+class EncounterState():
+    """ seneca inputs of one patient encounter: the latest (DateTime, value, unit) per de and source,
+        the condition code set and its elix score, plus the last seneca input and score rows.
+        every update only touches the de (or code set) it is about, so the cost does not grow with
+        the encounter's history
+    """
+
+    def __init__(self, id, age, sex, enctr_date:str, end_date:str=None):
+        self.id = id
+        self.age = age
+        self.sex = sex
+        self.enctr_date = enctr_date
+        self.end_date = end_date # None while the encounter is open
+        self.latest = {} # de -> {'labs': (DateTime, value, unit), 'vitals': (...)}
+        self.codes = set()
+        self.elix = elixhauserScore(self.codes)
+        self.seneca = None # cached getSenecaData row, None when an input changed
+        self.score = None
+
+    def addRow(self, row:tuple, source:str):
+        """folds one observationTuples row in; returns True when the de's value or unit changed"""
+        # rows without a data element are never used
+        de = row[9]
+        if de is None or pd.isna(de):
+            return False
+        by_source = self.latest.setdefault(de, {})
+        current = by_source.get(source)
+        # the latest DateTime per de and source wins and on a tie the later row, like getSenecaData
+        if current is not None and row[1] < current[0]:
+            return False
+        before = self.value(de)
+        by_source[source] = (row[1],) + senecaValue(de, row[2], row[3], source)
+        return self._changed(before, self.value(de))
+
+    def value(self, de):
+        """(value, unit) getSenecaData keeps for a de: the later of the latest lab and vital (the vital on a tie)"""
+        by_source = self.latest.get(de)
+        if not by_source:
+            return None
+        labs, vitals = by_source.get('labs'), by_source.get('vitals')
+        if labs is None or (vitals is not None and vitals[0] >= labs[0]):
+            return vitals[1:]
+        return labs[1:]
+
+    def inWindow(self, date:str):
+        """whether a YYYY-MM-DD date is inside the encounter's search window (getEncounterWindow)"""
+        return date is not None and date >= self.enctr_date and (self.end_date is None or date <= self.end_date)
+
+    def addCodes(self, codes):
+        """adds condition codes; returns True when the elix score changed"""
+        codes = set(codes) - self.codes
+        if not codes:
+            return False
+        self.codes |= codes
+        elix = elixhauserScore(self.codes)
+        changed = self._changed(elix, self.elix)
+        self.elix = elix
+        return changed
+
+    def _changed(self, before, after):
+        if _same(before, after):
+            return False
+        self.seneca = self.score = None
+        return True
+
+
+class FeatureStateStore():
+    """ in-memory seneca input state for many open encounters, keyed by (patient id, encounter id), so a
+        new Observation or Condition updates one de (or the code set) and only that encounter's one row
+        is scored again, instead of refetching and rebuilding getSenecaData from the full history.
+        rows and scores match getSenecaData/senecaScoreBatch on the same inputs. with snapshot_path the
+        state is loaded from that pickle when it exists and written back by snapshot()
+    Example:
+        store=FeatureStateStore(seneca_loincs, df_valuesets, snapshot_path='seneca_features.pkl')
+        store.open(pid, eid, df_pat, start_date_txt, df_vitals, df_labs, df_conds)
+        if store.addObservation(pid, eid, observation):
+            df_score=store.score(pid, eid)
+    """
+
+    def __init__(self, df_senecalist:pd.DataFrame, df_vs:pd.DataFrame, strict:bool=True, snapshot_path:str=None):
+        self.variables = list(zip(df_senecalist['key'], df_senecalist['variable_name']))
+        self.df_vs = df_vs
+        self.strict = strict
+        self.snapshot_path = snapshot_path
+        self.states = {}
+        self.patients = {} # patient id -> ids of its open encounters
+        self._lock = threading.RLock()
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            try:
+                with open(snapshot_path, 'rb') as f:
+                    self.states = pickle.load(f)
+            except Exception as e:
+                logging.warning(f"Could not load feature state snapshot {snapshot_path}: {e}")
+            for patient, encounter in self.states:
+                self.patients.setdefault(patient, set()).add(encounter)
+
+    def open(self, patient:str, encounter:str, df_pat:pd.DataFrame, enctr_date:str, df_vitals:pd.DataFrame=None,
+             df_labs:pd.DataFrame=None, df_conds:pd.DataFrame=None, end_date:str=None):
+        """starts (or replaces) an encounter's state from its parsed inputs, eg getPatientInputs frames.
+        enctr_date and end_date (None while the encounter is open) are its search window, YYYY-MM-DD"""
+        state = EncounterState(*senecaDemographics(df_pat, enctr_date), enctr_date, end_date)
+        for df, source in ((df_labs, 'labs'), (df_vitals, 'vitals')):
+            if df is not None:
+                for row in df[parse_fhir.observation_columns].itertuples(index=False, name=None):
+                    state.addRow(row, source)
+        if df_conds is not None:
+            state.addCodes(code for codes in df_conds['Codes'] for code in codes)
+        with self._lock:
+            self.states[(patient, encounter)] = state
+            self.patients.setdefault(patient, set()).add(encounter)
+        return state
+
+    def close(self, patient:str, encounter:str):
+        """forgets an encounter, eg once it is finished"""
+        with self._lock:
+            self.states.pop((patient, encounter), None)
+            self.patients.get(patient, set()).discard(encounter)
+            if not self.patients.get(patient):
+                self.patients.pop(patient, None)
+
+    def encounters(self, patient:str):
+        """ids of the open encounters of a patient"""
+        with self._lock:
+            return sorted(self.patients.get(patient, ()))
+
+    def addObservationRows(self, patient:str, encounter:str, rows:list, source:str):
+        """folds parsed observationTuples rows into an open encounter; returns True when its inputs changed"""
+        with self._lock:
+            state = self.states[(patient, encounter)]
+            changed = False
+            for row in rows:
+                changed = state.addRow(row, source) or changed
+            return changed
+
+    def addObservation(self, patient:str, encounter:str, observation:dict, source:str=None):
+        """parses one Observation resource into an open encounter; returns True when its inputs changed.
+        source defaults to the Observation's category; other categories are ignored, and so are
+        Observations dated outside the encounter's window, which its date=ge/le searches would not return"""
+        source = source or observationSource(observation)
+        if source is None:
+            return False
+        with self._lock:
+            if not self.states[(patient, encounter)].inWindow(observationDate(observation)):
+                return False
+        rows = parse_fhir.observationTuples(toBundle([observation]), self.df_vs, self.strict)
+        return self.addObservationRows(patient, encounter, rows, source)
+
+    def addCondition(self, patient:str, encounter:str, condition:dict):
+        """adds one Condition resource's icd10 codes to an open encounter; returns True when its elix score changed"""
+        df_conds = parse_fhir.parseCondition(toBundle([condition]), strict=self.strict)
+        with self._lock:
+            return self.states[(patient, encounter)].addCodes(code for codes in df_conds['Codes'] for code in codes)
+
+    def seneca(self, patient:str, encounter:str):
+        """the encounter's getSenecaData row"""
+        with self._lock:
+            state = self.states[(patient, encounter)]
+            if state.seneca is None:
+                values = []
+                for key, variable in self.variables:
+                    value = state.value(key)
+                    values.append(float('nan') if value is None else value[0])
+                result_t = pd.DataFrame([values], index=['value'], columns=pd.Index([v for k, v in self.variables], name='variable_name'), dtype=float)
+                result_t['elix'] = state.elix
+                result_t['age'] = state.age
+                result_t['sex'] = state.sex
+                result_t.insert(0, 'id', state.id)
+                state.seneca = result_t
+            return state.seneca
+
+    def score(self, patient:str, encounter:str):
+        """the encounter's senecaScoreBatch row, scored again only when its inputs changed since the last call"""
+        with self._lock:
+            state = self.states[(patient, encounter)]
+            if state.score is None:
+                state.score = senecaScoreBatch(self.seneca(patient, encounter))
+            return state.score
+
+    def snapshot(self, path:str=None):
+        """writes every encounter's state to path (default snapshot_path) as one pickle"""
+        path = path or self.snapshot_path
+        with self._lock:
+            data = pickle.dumps(self.states, protocol=pickle.HIGHEST_PROTOCOL)
+        # write then rename so a crash never leaves a half written snapshot
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
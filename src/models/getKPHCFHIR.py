@@ -2,7 +2,10 @@ import json
 import requests
 import logging
 import numpy as np
+import urllib.parse
 from controllers.fhir_connection import *
+from models.lru_cache import LruTtlCache
+from controllers.metrics import pages_fetched, medication_lookups, resourceFromUrl
 
 
 #get fhir patient identifier
@@ -13,7 +16,7 @@ def getPatientID(mrn:str, fhirconn:FhirConnection ):
     # get response that includes patient id
     # parse response to get the id
     try:
-        r = requests.post(geturl, json=request, **fhirconn.reqkwargs)
+        r = fhirconn.post(geturl, json=request)
         print(f'Status code:{r.status_code}')
         response=r.json()
         for item in response["Identifiers"]:
@@ -28,131 +31,193 @@ def getPatient(patID: str,fhirconn:FhirConnection):
     #funtion that is geturl that is a method of the fhirconn object
     geturl = fhirconn.getUrl(resourcetype="Patient")+'/' + patID
     try:
-        r = requests.get(geturl, **fhirconn.reqkwargs)
+        r = fhirconn.get(geturl)
         response = r.json()
     except Exception as e:
         logging.exception(f"Could not get resource: {e}")
     return response
 
 
-def getEncounterED(fhirconn:FhirConnection, start_date:str, end_date:str): #dates are yyyy-mm-dd (eg '2018-09-18') in string format
-    geturl = fhirconn.getUrl(resourcetype="Encounter")
-    if start_date!=None:
-        geturl=geturl+"&date=ge"+start_date
-    if end_date!=None:
-        geturl=geturl+"&date=le"+end_date
+# elements each parse_fhir parser reads, plus the ones fhir.resources requires for strict parsing. sent as
+# _elements so the server leaves out narrative text, extensions and the rest of what the parsers drop.
+# choice elements are named without their type (effective, value, onset, medication)
+search_elements = {
+    'Observation': ['status', 'code', 'effective', 'issued', 'value', 'component'],
+    'Condition': ['subject', 'category', 'code', 'onset'],
+    # code and form are for the _include'd Medications of a batch query (MedicationRequest has neither)
+    'MedicationRequest': ['status', 'intent', 'subject', 'encounter', 'authoredOn', 'medication', 'courseOfTherapyType',
+                          'code', 'form'],
+}
+
+def searchParams(resourcetype:str, fhirconn:FhirConnection):
+    """_elements (or _summary) and _count parameters for a search of resourcetype on fhirconn's server,
+    starting with & so they can be appended to a search url"""
+    params = ''
+    if getattr(fhirconn, 'search_elements', False) and resourcetype in search_elements:
+        params = params + '&_elements=' + ','.join(search_elements[resourcetype])
+    elif getattr(fhirconn, 'search_summary', None):
+        params = params + '&_summary=' + fhirconn.search_summary
+    page_sizer = getattr(fhirconn, 'page_sizer', None)
+    count = page_sizer.count(resourcetype) if page_sizer is not None else None
+    if count:
+        params = params + '&_count=' + str(count)
+    return params
+
+def _pageEntries(page:dict):
+    # entries that matched the search, not _include'd ones
+    return sum(1 for x in page.get('entry') or [] if (x.get('search') or {}).get('mode') != 'include')
+
+def iterPages(geturl:str, fhirconn:FhirConnection, first_page:dict=None, raise_errors:bool=False):
+    """generator that yields each bundle page of a fhir search, following link relation == "next"
+    through fhirconn.getNextUrl. a page is only fetched when the caller asks for it, so callers that
+    parse page by page never hold the whole result set. first_page is the search's first page when it
+    was already fetched (eg inside a batch Bundle); it is yielded without a request.
+    a page that cannot be fetched is logged and ends the search early, which looks the same as its last
+    page; raise_errors=True raises instead (also for a page that is not a Bundle, eg an OperationOutcome)
+    Example:
+        df = pd.concat([parse_fhir.parseCondition(x) for x in iterPages(geturl, fhirconn)])
+    """
     urlnext=geturl #initialize next url
-    page = 1
-    response_list = []
+    # next page urls do not always name the resource, so every page is labeled with the search's type
+    resource=resourceFromUrl(geturl)
+    # full pages followed by more pages let fhirconn.page_sizer grow _count for later searches
+    requested=urllib.parse.parse_qs(urllib.parse.urlsplit(geturl).query).get('_count')
+    requested=int(requested[0]) if requested else None
+    page_sizer=getattr(fhirconn, 'page_sizer', None)
     while urlnext is not None:
-        try:
-            r = requests.get(urlnext, **fhirconn.reqkwargs)
-            response = r.json()
-            response_list.append(response)
-            # get url for next page
-            # handle time out of next urls when we get a resourceType='OperationOutcome' with an error
+        if first_page is not None:
+            response, first_page = first_page, None
+        else:
             try:
-                urlraw=next((x.get('url') for x in response.get('link') if x.get('relation') == "next"),None)
+                r = fhirconn.get(urlnext, resource=resource)
+                response = r.json()
             except Exception as e:
-                logging.exception(f"error with {response.get('resourceType')}" )
-                urlraw = None
-            if urlraw is not None:
-                # urlnext = urllib.parse.urljoin(geturl, '?' + urlraw.split("?", 1)[1])
-                urlnext=fhirconn.getNextUrl(geturl, urlraw)
-                page=page+1
-            else:
-                urlnext = None
+                logging.exception(f"Could not get resource: {e}")
+                if raise_errors:
+                    raise
+                return
+        if raise_errors and response.get('resourceType') != 'Bundle':
+            raise Exception(f"Search page of {urlnext} is a {response.get('resourceType')}, not a Bundle")
+        # get url for next page
+        # handle time out of next urls when we get a resourceType='OperationOutcome' with an error
+        try:
+            urlraw=next((x.get('url') for x in response.get('link') if x.get('relation') == "next"),None)
         except Exception as e:
-            logging.exception(f"Could not get resource: {e}")
-    return response_list
+            logging.exception(f"error with {response.get('resourceType')}" )
+            urlraw = None
+        if urlraw is not None:
+            urlnext=fhirconn.getNextUrl(geturl, urlraw)
+        else:
+            urlnext = None
+        if page_sizer is not None and requested is not None:
+            page_sizer.observe(resource, requested, _pageEntries(response), urlnext is not None)
+        pages_fetched.inc(resource=resource)
+        yield response
+
+def iterEntries(geturl:str, fhirconn:FhirConnection):
+    """generator that yields the entry resources of every page of a fhir search"""
+    for page in iterPages(geturl, fhirconn):
+        for entry in page.get('entry') or []:
+            yield entry.get('resource')
+
+def getEncounterED(fhirconn:FhirConnection, start_date:str, end_date:str, stream:bool=False): #dates are yyyy-mm-dd (eg '2018-09-18') in string format
+    # the first filter starts the query string
+    dates=[]
+    if start_date!=None:
+        dates.append("date=ge"+start_date)
+    if end_date!=None:
+        dates.append("date=le"+end_date)
+    geturl = fhirconn.getUrl(resourcetype="Encounter")
+    if dates:
+        geturl=geturl+"?"+"&".join(dates)
+    pages=iterPages(geturl, fhirconn)
+    return pages if stream else list(pages)
 
 
-def getCondition(patID: str,fhirconn:FhirConnection, start_date:str, end_date:str):
+def getCondition(patID: str,fhirconn:FhirConnection, start_date:str, end_date:str, stream:bool=False, since:str=None, raise_errors:bool=False):
     # condition api does not take dates
     geturl = fhirconn.getUrl(resourcetype="Condition")+'?patient='+patID
-    urlnext=geturl #initialize next url
-    page = 1
-    response_list = []
-    while urlnext is not None:
-        try:
-            r = requests.get(urlnext, **fhirconn.reqkwargs)
-            response = r.json()
-            response_list.append(response)
-            # get url for next page
-            urlraw=next((x["url"] for x in response["link"] if x["relation"] == "next"),None)
-            if urlraw is not None:
-                urlnext=fhirconn.getNextUrl(geturl, urlraw)
-                page=page+1
-            else:
-                urlnext = None
-        except Exception as e:
-            logging.exception(f"Could not get resource: {e}")
-            urlnext=None
-    return response_list
+    # only resources changed after since (FHIR instant, eg 2023-01-01T00:00:00Z)
+    if since != None:
+        geturl = geturl + "&_lastUpdated=gt" + since
+    geturl = geturl + searchParams("Condition", fhirconn)
+    pages=iterPages(geturl, fhirconn, raise_errors=raise_errors)
+    return pages if stream else list(pages)
 
-def getObservation(patID: str, category:str,fhirconn:FhirConnection, start_date:str, end_date:str ):
+def getObservation(patID: str, category:str,fhirconn:FhirConnection, start_date:str, end_date:str, stream:bool=False, since:str=None, raise_errors:bool=False):
     geturl = fhirconn.getUrl(resourcetype="Observation")+'?patient='+patID+'&category='+category
     #add start and end if they exist
     if start_date != None:
         geturl = geturl + "&date=ge" + start_date
     if end_date != None:
         geturl = geturl + "&date=le" + end_date
+    # only resources changed after since (FHIR instant, eg 2023-01-01T00:00:00Z)
+    if since != None:
+        geturl = geturl + "&_lastUpdated=gt" + since
+    geturl = geturl + searchParams("Observation", fhirconn)
+    pages=iterPages(geturl, fhirconn, raise_errors=raise_errors)
+    return pages if stream else list(pages)
 
-    urlnext=geturl #initialize next url
-    page = 1
-    response_list = []
-    while urlnext is not None:
-        try:
-            r = requests.get(urlnext, **fhirconn.reqkwargs)
-            response = r.json()
-            response_list.append(response)
-            # get url for next page
-            urlraw=next((x["url"] for x in response["link"] if x["relation"] == "next"),None)
-            if urlraw is not None:
-                urlnext=fhirconn.getNextUrl(geturl, urlraw)
-                page=page+1
-            else:
-                urlnext = None
-        except Exception as e:
-            logging.exception(f"Could not get resource: {e}")
-    return response_list
-
-def getMedicationRequest(patID: str,fhirconn:FhirConnection, start_date:str, end_date:str):
+def getMedicationRequest(patID: str,fhirconn:FhirConnection, start_date:str, end_date:str, stream:bool=False, since:str=None, raise_errors:bool=False):
     geturl = fhirconn.getUrl(resourcetype="MedicationRequest")+'?patient='+patID+'&category=Inpatient'
     #add start and end if they exist
     if start_date != None:
         geturl = geturl + "&date=ge" + start_date
     if end_date != None:
         geturl = geturl + "&date=le" + end_date
+    # only resources changed after since (FHIR instant, eg 2023-01-01T00:00:00Z)
+    if since != None:
+        geturl = geturl + "&_lastUpdated=gt" + since
+    geturl = geturl + searchParams("MedicationRequest", fhirconn)
+    pages=iterPages(geturl, fhirconn, raise_errors=raise_errors)
+    return pages if stream else list(pages)
 
-    urlnext=geturl #initialize next url
-    page = 1
-    response_list = []
-    while urlnext is not None:
-        try:
-            r = requests.get(urlnext, **fhirconn.reqkwargs)
-            response = r.json()
-            response_list.append(response)
-            # get url for next page
-            urlraw=next((x["url"] for x in response["link"] if x["relation"] == "next"),None)
-            if urlraw is not None:
-                urlnext=fhirconn.getNextUrl(geturl, urlraw)
-                page=page+1
-            else:
-                urlnext = None
-        except Exception as e:
-            logging.exception(f"Could not get resource: {e}")
-    return response_list
+# Medication resources keyed by (fhir server, medication id), shared by every patient and page in a run
+medication_cache = LruTtlCache(maxsize=5000)
 
-def getMedication(medID: str,fhirconn:FhirConnection):
+def getMedication(medID: str,fhirconn:FhirConnection, cache:LruTtlCache=medication_cache):
     #Medication only takes med id
     # this is not a search so response will only return one resource
+    key = (fhirconn.url_root_fhir, medID)
+    if cache is not None:
+        response = cache.get(key)
+        if response is not None:
+            medication_lookups.inc(source='cache')
+            return response
+    medication_lookups.inc(source='server')
     geturl = fhirconn.getUrl(resourcetype="medication")+'/'+medID
 
     try:
-        r = requests.get(geturl, **fhirconn.reqkwargs)
+        r = fhirconn.get(geturl)
         response = r.json()
+        # only cache real Medication resources, not OperationOutcome errors
+        if cache is not None and response.get('resourceType') == 'Medication':
+            cache.put(key, response)
     except Exception as e:
         logging.exception(f"Could not get resource: {e}")
     return response
 
+def getMedications(medIDs:list, fhirconn:FhirConnection, cache:LruTtlCache=medication_cache, chunk_size:int=100):
+    """ resolves many Medication ids at once. ids already in the cache are not requested again and the
+        rest are fetched with _id=a,b,c searches of up to chunk_size ids each
+    Returns:
+        dict of medication id -> Medication resource (ids the server did not return are left out)
+    """
+    medications = {}
+    missing = []
+    for medID in dict.fromkeys(medIDs): # unique, keeps order
+        response = cache.get((fhirconn.url_root_fhir, medID)) if cache is not None else None
+        if response is not None:
+            medications[medID] = response
+        else:
+            missing.append(medID)
+    medication_lookups.inc(len(medications), source='cache')
+    medication_lookups.inc(len(missing), source='batch')
+    for i in range(0, len(missing), chunk_size):
+        geturl = fhirconn.getUrl(resourcetype="medication")+'?_id='+','.join(missing[i:i+chunk_size])
+        for resource in iterEntries(geturl, fhirconn):
+            if resource is not None and resource.get('resourceType') == 'Medication':
+                medications[resource.get('id')] = resource
+                if cache is not None:
+                    cache.put((fhirconn.url_root_fhir, resource.get('id')), resource)
+    return medications
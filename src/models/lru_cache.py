@@ -0,0 +1,43 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LruTtlCache():
+    """ thread safe lru cache with a time to live. entries are evicted when the cache holds more than
+        maxsize items or are older than ttl seconds. getKPHCFHIR.medication_cache (Medication resources)
+        and controller_utilities.mrn_cache (hapi patient id -> MRN) are instances
+    Example:
+        cache=LruTtlCache(maxsize=1000, ttl=3600)
+        cache.put(key, value)
+        value=cache.get(key) # None when missing or expired
+    """
+
+    def __init__(self, maxsize:int=5000, ttl:float=24*60*60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            stored, value = item
+            if time.monotonic() - stored > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
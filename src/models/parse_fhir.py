@@ -1,22 +1,98 @@
 import json
+import datetime
+import importlib
+import threading
 
-from fhir.resources.patient import Patient
-from fhir.resources.bundle import Bundle
-from fhir.resources.location import Location
-from fhir.resources.encounter import Encounter
-from fhir.resources.observation import Observation
-from fhir.resources.medicationrequest import MedicationRequest
-from fhir.resources.medication import Medication
-from fhir.resources.fhirtypes import Id
 from models.getKPHCFHIR import *
+from controllers.metrics import timed, parse_seconds, parse_errors
 from exceptions.parseexceptions import FHIRParseError, NoSearchResults
 
+import numpy as np
 import pandas as pd
-#allow resources in the fhir.ressources validation to have length as long as max_length (default length of 64 is too short for KPHC resources and causes an error)
-Id.configure_constraints(min_length=1, max_length=5000)
+
+_fhir_lock = threading.Lock()
+_fhir_configured = False
+
+def _fhirType(module:str, name:str):
+    """imports a fhir.resources class, configuring fhir.resources the first time"""
+    global _fhir_configured
+    with _fhir_lock:
+        if not _fhir_configured:
+            from fhir.resources.fhirtypes import Id
+            #allow resources in the fhir.ressources validation to have length as long as max_length (default length of 64 is too short for KPHC resources and causes an error)
+            Id.configure_constraints(min_length=1, max_length=5000)
+            _fhir_configured = True
+    return getattr(importlib.import_module('fhir.resources.' + module), name)
+
+class _LazyFhirType():
+    """ stands in for a fhir.resources class and imports it on first attribute access (eg Bundle.parse_raw).
+        importing fhir.resources takes seconds, which callers that only use strict=False never pay
+    """
+
+    def __init__(self, module:str, name:str):
+        self._module = module
+        self._name = name
+        self._type = None
+
+    def __getattr__(self, attr):
+        if self._type is None:
+            self._type = _fhirType(self._module, self._name)
+        return getattr(self._type, attr)
+
+Patient = _LazyFhirType('patient', 'Patient')
+Bundle = _LazyFhirType('bundle', 'Bundle')
+Location = _LazyFhirType('location', 'Location')
+Encounter = _LazyFhirType('encounter', 'Encounter')
+Observation = _LazyFhirType('observation', 'Observation')
+MedicationRequest = _LazyFhirType('medicationrequest', 'MedicationRequest')
+Medication = _LazyFhirType('medication', 'Medication')
+
+def loadFhirResources():
+    """imports the fhir.resources classes now instead of on the first strict parse (eg while a service starts)"""
+    for fhir_type in (Patient, Bundle, Location, Encounter, Observation, MedicationRequest, Medication):
+        fhir_type.parse_raw
 #print all columns
 pd.options.display.width = 0
 
+# raw dict fields that fhir.resources would turn into datetimes/dates
+_fast_datetime_fields = {'issued', 'effectiveDateTime', 'authoredOn', 'start', 'end'}
+_fast_date_fields = {'birthDate'}
+
+def _fastDateTime(value:str):
+    # same as the issued fix in parseObservation: times without a timezone are taken as UTC
+    dt = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt
+
+def _fastValue(name:str, value):
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        return FastResource(value)
+    if isinstance(value, list):
+        return [_fastValue(name, x) for x in value]
+    if name in _fast_datetime_fields:
+        return _fastDateTime(value)
+    if name in _fast_date_fields:
+        return datetime.date.fromisoformat(value)
+    return value
+
+class FastResource():
+    """ read-only attribute view over a raw fhir dict, used by the parsers when strict=False.
+        fields are only converted when a parser reads them (missing keys read as None, the datetime
+        fields above become datetimes), so there is no json round trip and no pydantic validation
+    """
+    __slots__ = ('_data',)
+
+    def __init__(self, data:dict):
+        self._data = data
+
+    def __getattr__(self, name):
+        if name == 'resource_type':
+            return self._data.get('resourceType')
+        return _fastValue(name, self._data.get(name))
+
 def bestLoinc(codes: list, df:pd.DataFrame ): # df = data element list
     if len(codes)==0:
         codes=[(None,None,None)]
@@ -34,12 +110,63 @@ def bestLoinc(codes: list, df:pd.DataFrame ): # df = data element list
     #print(result)
     return dict_result
 
-def parsePatient(data):
+class LoincIndex():
+    """ the valueset table compiled once into a dict of code -> first valueset row, so parseObservation
+        resolves codes with dict lookups instead of a bestLoinc merge per observation.
+        best() returns the same record as bestLoinc(codes, df)[0]: the first code in the list joined
+        to its first valueset row, or that code with NaN valueset columns when it is not in the table
+    """
+
+    def __init__(self, df:pd.DataFrame):
+        # column names as they come out of the bestLoinc merge (overlapping names get suffixes)
+        left_cols = ['id', 'loinc_code', 'loinc_description']
+        self.left_names = [col + '_left' if col in df.columns else col for col in left_cols]
+        right_names = [col + '_right' if col in left_cols else col for col in df.columns]
+        self.codes = {}
+        for record in df.to_dict(orient='records'):
+            code = record['code']
+            if code not in self.codes: # first row wins, same as the merge order
+                self.codes[code] = {name: record[col] for name, col in zip(right_names, df.columns)}
+        self.empty = {name: np.nan for name in right_names}
+        # the merge turns integer columns into floats when any code in the list has no match
+        self.int_cols = [name for name, col in zip(right_names, df.columns) if pd.api.types.is_integer_dtype(df[col])]
+        # what a None becomes in a DataFrame column that also holds strings: NaN where pandas infers
+        # a string dtype (pandas 3), None with object columns
+        self.missing = pd.DataFrame([(None,), ('',)])[0].iloc[0]
+
+    def best(self, codes:list):
+        if len(codes)==0:
+            codes=[(None,None,None)]
+        id, code, description = codes[0]
+        values = [id, code, description]
+        for i in range(3):
+            if values[i] is None and any(isinstance(c[i], str) for c in codes):
+                values[i] = self.missing
+        record = dict(zip(self.left_names, values))
+        record.update(self.codes.get(code, self.empty))
+        if self.int_cols and any(c[1] not in self.codes for c in codes):
+            for name in self.int_cols:
+                record[name] = float(record[name])
+        return record
+
+_loinc_indexes = {}
+
+def getLoincIndex(df:pd.DataFrame):
+    """returns the LoincIndex for a valueset dataframe, compiling it the first time it is seen"""
+    entry = _loinc_indexes.get(id(df))
+    if entry is None or entry[0] is not df:
+        entry = (df, LoincIndex(df)) # keep df so its id is not reused
+        _loinc_indexes[id(df)] = entry
+    return entry[1]
+
+@timed(parse_seconds, parser='patient')
+def parsePatient(data, strict:bool=True):
     '''parse patient resource to get sex and dob and return dataframe
+       strict=False reads the raw dict through FastResource instead of validating with fhir.resources
     '''
     # fhir.resources thinks epic patient is in wrong format if it has a link key in response since it may not include "other" key
     try:
-        resourcepat = Patient.parse_raw(json.dumps(data))
+        resourcepat = Patient.parse_raw(json.dumps(data)) if strict else FastResource(data)
         pat_list = []
         id=resourcepat.id
         sex=resourcepat.gender
@@ -57,19 +184,37 @@ def parsePatient(data):
     df_pat=pd.DataFrame(pat_list,columns = ['id', 'sex', 'dob', 'deceased_ind'])
     return df_pat
 
-def parseObservation(data,df_vs:pd.DataFrame): #df_vs=dataframe with valueset/loinc mapping
-    try: # see if issued data is correct format
-        bundle = Bundle.parse_raw(json.dumps(data))
-    except: #fix format in issued field of observation lab resource
-        for entry in data["entry"]:
-            if entry["resource"]["issued"] is not None:
-                z=entry["resource"]["issued"]
-                entry["resource"]["issued"]=z + "+00:00"
-            elif entry["resource"]["effectiveDateTime"] is not None:
-                z = entry["resource"]["issued"]
-                entry["resource"]["issued"] = z + "+00:00"
-        bundle = Bundle.parse_raw(json.dumps(data))
-        # loinc_codes=[]
+observation_columns = ['id', 'DateTime', 'value', 'unit','loinc_list', 'system', 'code',
+                       'display', 'text','de','de_name','culture_indicator']
+
+def parseObservation(data,df_vs:pd.DataFrame,strict:bool=True): #df_vs=dataframe with valueset/loinc mapping
+    #turn vital list into dataframe
+    df_obs=pd.DataFrame(observationTuples(data, df_vs, strict),columns = observation_columns)
+    # print(df_obs)
+    return df_obs
+
+@timed(parse_seconds, parser='observation')
+def observationTuples(data,df_vs:pd.DataFrame,strict:bool=True):
+    '''parses an Observation bundle page into a list of tuples (observation_columns order) sorted by id.
+       parseObservation turns this into a dataframe; LatestObservationReducer consumes it directly.
+       strict=False skips fhir.resources validation and reads the raw dict through FastResource
+    '''
+    if not strict:
+        bundle = FastResource(data)
+    else:
+        try: # see if issued data is correct format
+            bundle = Bundle.parse_raw(json.dumps(data))
+        except: #fix format in issued field of observation lab resource
+            for entry in data["entry"]:
+                if entry["resource"]["issued"] is not None:
+                    z=entry["resource"]["issued"]
+                    entry["resource"]["issued"]=z + "+00:00"
+                elif entry["resource"]["effectiveDateTime"] is not None:
+                    z = entry["resource"]["issued"]
+                    entry["resource"]["issued"] = z + "+00:00"
+            bundle = Bundle.parse_raw(json.dumps(data))
+            # loinc_codes=[]
+    loinc_index = getLoincIndex(df_vs)
     try:
         if bundle.entry is None:
             raise NoSearchResults(requestType='Observation (Vitals)')
@@ -101,7 +246,7 @@ def parseObservation(data,df_vs:pd.DataFrame): #df_vs=dataframe with valueset/lo
                             bp_loinc_list=loinc_code_list.copy()
                             bp_loinc_list.append(coding.code)
                             if vitalsign.valueQuantity and vitalsign.valueQuantity.value:
-                                df_loinc = bestLoinc([[observation.id,coding.code,coding.display]], df_vs)[0]
+                                df_loinc = loinc_index.best([(observation.id,coding.code,coding.display)])
                                 if df_loinc["de_name"] == 'Blood culture':
                                     culture_ind = 1
                                 else:
@@ -124,7 +269,7 @@ def parseObservation(data,df_vs:pd.DataFrame): #df_vs=dataframe with valueset/lo
                     obs_unit = 'none'
                     # function here to identify loinc code to go into the missing values below
                     # input should be loinc_code list
-                df_loinc=bestLoinc(loinc_codes,df_vs)[0]
+                df_loinc=loinc_index.best(loinc_codes)
                 if df_loinc["de_name"] == 'Blood culture':
                     culture_ind = 1
                 else:
@@ -140,22 +285,73 @@ def parseObservation(data,df_vs:pd.DataFrame): #df_vs=dataframe with valueset/lo
         vital_list=[]
     except Exception as e:
         logging.exception(f"Error parsing resource: {e}")
+        parse_errors.inc(parser='observation')
         vital_list=[]
-    #turn vital list into dataframe
-    df_obs=pd.DataFrame(vital_list,columns = ['id', 'DateTime', 'value', 'unit','loinc_list', 'system', 'code',
-                                              'display', 'text','de','de_name','culture_indicator'])
-    # print(df_obs)
-    return df_obs
+    return vital_list
+
+class LatestObservationReducer():
+    ''' keeps only the most recent observation per data element (de) for one patient while Observation
+        pages stream in. each page is parsed to tuples, folded into the current latest rows and dropped,
+        so memory does not grow with the number of observations.
+        frames() gives the same rows getSenecaData keeps from the full parseObservation dataframes:
+        the latest DateTime per de and source wins and on a tie the later row (in page order, then
+        parseObservation's id order) wins
+    Example:
+        reducer=LatestObservationReducer(df_valuesets)
+        for page in getObservation(patID=pid, category='vital-signs', fhirconn=conn, start_date=s, end_date=e, stream=True):
+            reducer.addPage(page, 'vitals')
+        df_vitals, df_labs = reducer.frames()
+    '''
+
+    def __init__(self, df_vs:pd.DataFrame, strict:bool=True):
+        self.df_vs = df_vs
+        self.strict = strict
+        self.latest = {'vitals': {}, 'labs': {}}
+
+    def addRow(self, row:tuple, source:str):
+        # row is in observation_columns order; rows without a data element are never used
+        de = row[9]
+        if de is None or pd.isna(de):
+            return
+        current = self.latest[source].get(de)
+        if current is None or row[1] >= current[1]:
+            self.latest[source][de] = row
+
+    def addRows(self, rows:list, source:str):
+        '''folds already parsed observationTuples rows (e.g. from a ParseStage worker)'''
+        for row in rows:
+            self.addRow(row, source)
+
+    def addPage(self, data, source:str):
+        self.addRows(observationTuples(data, self.df_vs, self.strict), source)
+
+    def frames(self):
+        '''returns (dfVitals, dfLabs) with one parseObservation row per de'''
+        return (pd.DataFrame(list(self.latest['vitals'].values()), columns=observation_columns),
+                pd.DataFrame(list(self.latest['labs'].values()), columns=observation_columns))
 
 #vs is valueset list
-def parseMedRequest(data,fhirconn:FhirConnection,start_date,vs:list): #need auth to for getMedication resource call; start_date to filter medRequest resources by date since epic has no date filter on request url
-    bundle = Bundle.parse_raw(json.dumps(data))
+@timed(parse_seconds, parser='medication_request')
+def parseMedRequest(data,fhirconn:FhirConnection,start_date,vs:list,batch:bool=False,strict:bool=True,lookup=None): #need auth to for getMedication resource call; start_date to filter medRequest resources by date since epic has no date filter on request url
+    """batch=True resolves every Medication referenced in the bundle with one _id=a,b,c search
+    (getMedications) instead of one read per MedicationRequest. both paths use the shared medication_cache.
+    lookup replaces getMedications for batch=True: a function of a list of Medication ids that returns a
+    dict of id -> Medication, eg BulkData.getMedications. ids it leaves out are read from the server
+    strict=False reads the raw dicts through FastResource instead of validating with fhir.resources
+    """
+    bundle = Bundle.parse_raw(json.dumps(data)) if strict else FastResource(data)
     # Create tuples from vitals issued date and their associated values
     med_tuples = []
     try:
         if bundle.entry is None:
             raise NoSearchResults(requestType='MedicationRequest')
         medreq = [medicationrequestentry.resource for medicationrequestentry in bundle.entry]
+        medications = {}
+        if batch:
+            rxids = [req.medicationReference.reference.split("/")[1] for req in medreq
+                     if req.resource_type != 'OperationOutcome' and req.authoredOn>=start_date
+                     and req.medicationReference.reference is not None]
+            medications = lookup(rxids) if lookup is not None else getMedications(rxids, fhirconn=fhirconn)
         for req in medreq:
             # medrequest sometimes has admin statements at end that are of type OperationOutcome
             if req.resource_type != 'OperationOutcome':
@@ -176,8 +372,10 @@ def parseMedRequest(data,fhirconn:FhirConnection,start_date,vs:list): #need auth
                     days, seconds = time_diff.days, time_diff.seconds
                     time_diff_hours = days * 24 + seconds / 3600
                     # get medication resource for rxNorm
-                    medication = getMedication(rxid, fhirconn=fhirconn)
-                    resourcemed = Medication.parse_raw(json.dumps(medication))
+                    medication = medications.get(rxid)
+                    if medication is None:
+                        medication = getMedication(rxid, fhirconn=fhirconn)
+                    resourcemed = Medication.parse_raw(json.dumps(medication)) if strict else FastResource(medication)
                     try:
                         medtext = resourcemed.code.text
                     except:
@@ -205,6 +403,7 @@ def parseMedRequest(data,fhirconn:FhirConnection,start_date,vs:list): #need auth
         med_tuples=[]
     except Exception as e:
         logging.exception(f"Error parsing resource: {e}")
+        parse_errors.inc(parser='medication_request')
         med_tuples=[]
     # print(med_tuples)
     df_meds = pd.DataFrame(med_tuples,
@@ -222,8 +421,10 @@ def abx_in_timeframe(df, hours=6):
     df_return=df_return[keep_cols]
     return df_return
 
-def parseCondition(data):
-    bundle = Bundle.parse_raw(json.dumps(data))
+@timed(parse_seconds, parser='condition')
+def parseCondition(data, strict:bool=True):
+    #strict=False skips fhir.resources validation and reads the raw dict through FastResource
+    bundle = Bundle.parse_raw(json.dumps(data)) if strict else FastResource(data)
     tuples = []
     try:
         if bundle.entry is None:
@@ -260,7 +461,46 @@ def parseCondition(data):
         tuples = []
     except Exception as e:
         logging.exception(f"Error parsing resource: {e}")
+        parse_errors.inc(parser='condition')
         tuples = []
     #create dataframe from tuples list
     df_cond = pd.DataFrame(tuples, columns=['id', 'StartDate', 'EndDate', 'ListType', 'Codes', 'Description'])
-    return df_cond
\ No newline at end of file
+    return df_cond
+
+@timed(parse_seconds, parser='encounter')
+def parseEncProgInputs(data, strict:bool=True):
+    '''parse an Encounter bundle page into the cohort columns getHapiCohort needs.
+       start_date/end_date are UTC "YYYY-MM-DD HH:MM:SS" strings (end_date is None for open encounters)
+       strict=False reads the raw dict through FastResource instead of validating with fhir.resources
+    '''
+    bundle = Bundle.parse_raw(json.dumps(data)) if strict else FastResource(data)
+    tuples = []
+    try:
+        if bundle.entry is None:
+            raise NoSearchResults(requestType='Encounter')
+        for encounter in [encounterentry.resource for encounterentry in bundle.entry]:
+            if encounter.resource_type == 'OperationOutcome':
+                continue
+            try:
+                patid = encounter.subject.reference.split("/")[1]
+            except:
+                patid = None
+            try:
+                start_date = encounter.period.start.astimezone(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            except:
+                start_date = None
+            try:
+                end_date = encounter.period.end.astimezone(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            except:
+                end_date = None
+            # urn is only used by epic to look up the fhir id; hapi encounters do not have one
+            tuples.append((patid, encounter.id, start_date, end_date, None))
+    except NoSearchResults as e:
+        print(e)
+        tuples = []
+    except Exception as e:
+        logging.exception(f"Error parsing resource: {e}")
+        parse_errors.inc(parser='encounter')
+        tuples = []
+    df_enc = pd.DataFrame(tuples, columns=['patid', 'pat_enc_csn_id', 'start_date', 'end_date', 'urn'])
+    return df_enc
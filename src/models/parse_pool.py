@@ -0,0 +1,122 @@
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import models.parse_fhir as parse_fhir
+
+# valueset table of a ParseStage worker process, set once by _initWorker instead of being sent with every page
+_worker_df_vs = None
+
+
+def _initWorker(df_vs:pd.DataFrame):
+    global _worker_df_vs
+    _worker_df_vs = df_vs
+
+
+def _observationTuples(data, strict:bool):
+    return parse_fhir.observationTuples(data, _worker_df_vs, strict)
+
+
+def _parsePatient(data, strict:bool):
+    return parse_fhir.parsePatient(data, strict=strict)
+
+
+def _parseCondition(data, strict:bool):
+    return parse_fhir.parseCondition(data, strict=strict)
+
+
+def availableCores():
+    """cores this process may run on (the affinity mask on linux batch nodes, else cpu_count)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class ParseStage():
+    """ process pool that parses fetched bundle pages off the fetching threads, so the cpu bound
+        fhir.resources validation and per-observation loops use every core while fetches continue.
+        at most max_pending pages are queued, being parsed or parsed but not yet folded in at once;
+        the fetching thread waits when they are all taken, which bounds memory to about max_pending pages.
+        MedicationRequest pages are not sent here because parsing them fetches Medications
+    Example:
+        with ParseStage(df_valuesets) as parser:
+            senecaControl(df, conn, max_workers=8, parser=parser)
+    """
+
+    def __init__(self, df_vs:pd.DataFrame, max_workers:int=None, max_pending:int=None):
+        self.max_workers = max_workers or availableCores()
+        self.max_pending = max_pending or self.max_workers * 2
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        # spawn: the fetch threads are already running when workers start, and forking a threaded process is unsafe
+        self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=_initWorker, initargs=(df_vs,))
+
+    def submit(self, fn, *args):
+        """queues one parse; blocks while max_pending parses are outstanding"""
+        self._slots.acquire()
+        future = self._submitHeld(fn, *args)
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def _submitHeld(self, fn, *args):
+        # submits with a slot the caller already acquired and releases itself
+        try:
+            return self._pool.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def observationTuples(self, data, strict:bool=True):
+        return self.submit(_observationTuples, data, strict)
+
+    def parsePatient(self, data, strict:bool=True):
+        return self.submit(_parsePatient, data, strict)
+
+    def parseCondition(self, data, strict:bool=True):
+        return self.submit(_parseCondition, data, strict)
+
+    def reduceObservations(self, pages, source:str, reducer:parse_fhir.LatestObservationReducer):
+        """parses Observation pages in the pool while the next ones are fetched and folds the results
+        into reducer in page order (so ties resolve exactly as with reducer.addPage)
+        Returns:
+            number of pages
+        """
+        # a page's slot is held until its rows are folded in, so parsed pages waiting behind a slow one
+        # count against max_pending. when no slot is free the oldest page is waited for and folded
+        # rather than blocking, since the slots this call holds are only freed by this call
+        pending = deque()
+        n_pages = 0
+        try:
+            for page in pages:
+                while not self._slots.acquire(blocking=not pending):
+                    self._fold(pending, source, reducer)
+                pending.append(self._submitHeld(_observationTuples, page, reducer.strict))
+                n_pages = n_pages + 1
+                while pending and pending[0].done():
+                    self._fold(pending, source, reducer)
+            while pending:
+                self._fold(pending, source, reducer)
+        finally:
+            # after an error the rest are not folded; free their slots
+            for future in pending:
+                future.cancel()
+                self._slots.release()
+        return n_pages
+
+    def _fold(self, pending:deque, source:str, reducer:parse_fhir.LatestObservationReducer):
+        future = pending.popleft()
+        try:
+            reducer.addRows(future.result(), source)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
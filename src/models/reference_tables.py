@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import pandas as pd
+
+# bump when the artifact layout changes so old artifacts are rebuilt
+artifact_version = 1
+
+_tables = {} # (csv path, read_csv kwargs) -> dataframe, for the life of the process
+_tables_lock = threading.Lock()
+
+
+def _fileDigest(path:str):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def artifactPath(csv_path:str):
+    """where the compiled artifact of csv_path lives: __refcache__/<csv name>.pkl next to the csv,
+    like __pycache__ for modules"""
+    directory, name = os.path.split(os.path.abspath(csv_path))
+    return os.path.join(directory, '__refcache__', name + '.pkl')
+
+
+def compileReferenceTable(csv_path:str, artifact_path:str=None, **read_csv_kwargs):
+    """reads csv_path with pd.read_csv and writes it as a pickled dataframe artifact stamped with the
+    csv's size, mtime and sha256. returns the dataframe; a failed artifact write is only logged"""
+    artifact_path = artifact_path or artifactPath(csv_path)
+    stat = os.stat(csv_path)
+    df = pd.read_csv(csv_path, **read_csv_kwargs)
+    stamp = {'version': artifact_version, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+             'sha256': _fileDigest(csv_path), 'kwargs': repr(sorted(read_csv_kwargs.items()))}
+    _writeArtifact(artifact_path, stamp, df)
+    return df
+
+
+def _writeArtifact(artifact_path:str, stamp:dict, df:pd.DataFrame):
+    try:
+        os.makedirs(os.path.dirname(artifact_path), exist_ok=True)
+        tmp_path = f'{artifact_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'stamp': stamp, 'table': df}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, artifact_path) # readers never see a partial artifact
+    except OSError as e:
+        logging.warning(f"Could not write reference table artifact {artifact_path}: {e}")
+
+
+def loadReferenceTable(csv_path:str, artifact_path:str=None, **read_csv_kwargs):
+    """ returns the dataframe pd.read_csv(csv_path, **read_csv_kwargs) would, from its compiled artifact
+        when that is current. the artifact is rebuilt when the csv's size or mtime changed and its content
+        hash no longer matches, or when read_csv_kwargs differ. each table is loaded once per process and
+        the same dataframe is returned on later calls (so caches keyed on it, like getLoincIndex, hold)
+    Example:
+        df_valuesets=loadReferenceTable('DE_valuesets_with_names.csv', encoding='unicode_escape')
+    """
+    key = (os.path.abspath(csv_path), repr(sorted(read_csv_kwargs.items())))
+    with _tables_lock:
+        df = _tables.get(key)
+        if df is None:
+            df = _tables[key] = _loadArtifact(csv_path, artifact_path or artifactPath(csv_path), read_csv_kwargs)
+        return df
+
+
+def _loadArtifact(csv_path:str, artifact_path:str, read_csv_kwargs:dict):
+    stat = os.stat(csv_path)
+    try:
+        with open(artifact_path, 'rb') as f:
+            artifact = pickle.load(f)
+        stamp = artifact['stamp']
+    except FileNotFoundError:
+        return compileReferenceTable(csv_path, artifact_path, **read_csv_kwargs)
+    except Exception as e:
+        logging.warning(f"Rebuilding unreadable reference table artifact {artifact_path}: {e}")
+        return compileReferenceTable(csv_path, artifact_path, **read_csv_kwargs)
+    if stamp.get('version') != artifact_version or stamp.get('kwargs') != repr(sorted(read_csv_kwargs.items())):
+        return compileReferenceTable(csv_path, artifact_path, **read_csv_kwargs)
+    if (stamp.get('size'), stamp.get('mtime_ns')) != (stat.st_size, stat.st_mtime_ns):
+        if stamp.get('size') != stat.st_size or stamp.get('sha256') != _fileDigest(csv_path):
+            return compileReferenceTable(csv_path, artifact_path, **read_csv_kwargs)
+        # only touched (eg checked out again); restamp so the hash is not checked every load
+        _writeArtifact(artifact_path, dict(stamp, mtime_ns=stat.st_mtime_ns), artifact['table'])
+    return artifact['table']
+
+
+def clearReferenceTables():
+    """forgets the tables loaded in this process so the next load checks the artifacts again"""
+    with _tables_lock:
+        _tables.clear()